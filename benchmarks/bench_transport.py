@@ -0,0 +1,106 @@
+#%% Imports
+
+import argparse
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from lumerical_lib import crystal
+
+# Compares the three ways of sending a crystal to the solver:
+#   text    - generate_script(), one addcircle block per hole
+#   compact - generate_script(compact=True), matrices + for loops in the text
+#   putv    - circle_table() through putv, the group script only walks it
+#             and instances the bends, as Fdtd.add_crystal(putv=True)
+# Without --solver only the python side (generation and payload size) is
+# measured. With --solver each mode also goes through Fdtd.add_crystal on a
+# live session, or with --fake on an in-memory solver.RecordingBackend that
+# waits --latency seconds per round trip.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, nargs='+', default=[20, 80, 200])
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--solver', action='store_true')
+parser.add_argument('--fake', action='store_true')
+parser.add_argument('--latency', type=float, default=1e-3)
+args = parser.parse_args()
+
+
+def make_crystal(n):
+    # n x n lattice of '0' with a W1 waveguide of '.' in the middle row
+    rows = []
+    for row in range(n):
+        simbol = '.' if row == n // 2 else '0'
+        line = ' '.join(simbol * n)
+        rows.append(' ' + line if row % 2 == 0 else line + ' ')
+    return crystal.Crystal(f'bench{n}', model='\n'.join(rows))
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for __r in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def python_side(pc):
+    results = {}
+
+    def text():
+        pc.invalidate()  # drop the cached table
+        return pc.generate_script()
+
+    def compact():
+        pc.invalidate()
+        return pc.generate_script(compact=True)
+
+    def putv():
+        pc.invalidate()
+        return (pc.circle_table(),
+                pc.generate_script(compact=True, circles=False) + pc.holes_script('holes'))
+
+    results['text'] = (best_of(text, args.repeat), len(text()))
+    results['compact'] = (best_of(compact, args.repeat), len(compact()))
+    holes, script = putv()
+    results['putv'] = (best_of(putv, args.repeat), holes.nbytes + len(script))
+    return results
+
+
+def solver_side(pc):
+    from lumerical_lib import fdtd, solver
+
+    backend = solver.RecordingBackend(args.latency) if args.fake else None
+    f = fdtd.Fdtd(new=True, backend=backend)
+    results = {}
+    for mode, kwargs in [('text', {}), ('compact', {'compact': True}),
+                         ('putv', {'putv': True})]:
+        def run():
+            pc.invalidate()
+            f.last_crystal_x = 0
+            f.add_crystal(pc, **kwargs)
+        results[mode] = best_of(run, args.repeat)
+    return results
+
+
+#%% Run
+
+solving = args.solver or args.fake
+
+print(f'{"holes":>8} {"mode":>8} {"python (ms)":>12} {"payload (kB)":>13}'
+      + (f' {"solver (ms)":>12}' if solving else ''))
+
+for n in args.size:
+    pc = make_crystal(n)
+    holes = len(pc.circle_table())
+    python = python_side(pc)
+    solver = solver_side(pc) if solving else {}
+
+    for mode, (elapsed, payload) in python.items():
+        line = f'{holes:>8} {mode:>8} {elapsed*1e3:>12.2f} {payload/1e3:>13.1f}'
+        if mode in solver:
+            line += f' {solver[mode]*1e3:>12.2f}'
+        print(line)
@@ -1,23 +1,10 @@
 import numpy as np
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
-from scipy import interpolate
 from collections import OrderedDict
 
-import importlib.util
 import os
 import shutil
 
-os.add_dll_directory('C:\\Program Files\\Lumerical\\v202\\api\\python')
-spec_win = importlib.util.spec_from_file_location(
-    'lumapi', 'C:\\Program Files\\Lumerical\\v202\\api\\python\\lumapi.py')
-spec_lin = importlib.util.spec_from_file_location(
-    'lumapi', "/opt/lumerical/2020a/api/python/lumapi.py")
-spec_mac = importlib.util.spec_from_file_location(
-    'luampi', "/Applications/Lumerical/FDTD Solutions/FDTD Solutions.app/Contents/API/Python/lumapi.py")
-
-lumapi = importlib.util.module_from_spec(spec_win)
-spec_win.loader.exec_module(lumapi)
+from lumerical_lib import solver
 
 
 class Crystal(object):
@@ -29,6 +16,11 @@ class Crystal(object):
         self.first_null = False
         self.a = a
         self.zspan = zspan
+        # bumped on every change of the model, stamps the cached matrix
+        self.version = 0
+        self.matrix = None
+        self.matrix_version = -1
+        self.file_mtime = None
 
         if os.path.exists(f'{self.name}_crystal_model.txt'):
             self.read_crystal_file()
@@ -45,11 +37,12 @@ class Crystal(object):
 
     def __iter__(self):
         self.iter_aux = 0
+        self.iter_lines = self.model.splitlines()
         return self
 
     def __next__(self):
         if self.iter_aux < self.y:
-            line = self.model.splitlines()[self.iter_aux].split()
+            line = self.iter_lines[self.iter_aux].split()
             self.iter_aux += 1
             return line
         else:
@@ -101,6 +94,9 @@ class Crystal(object):
         if self.model.splitlines()[-1][0] == ' ':
             self.first_null = True
 
+        self.file_mtime = os.path.getmtime(f'{self.name}_crystal_model.txt')
+        self.version += 1
+
     def expand_x(self, n=1):
         self.read_crystal_file()
 
@@ -114,6 +110,7 @@ class Crystal(object):
 
         with open(f'{self.name}_crystal_model.txt', 'w') as file:
             file.write(self.model)
+        self.read_crystal_file()
 
     def reduce_x(self, n=1):
         self.read_crystal_file()
@@ -128,19 +125,27 @@ class Crystal(object):
 
         with open(f'{self.name}_crystal_model.txt', 'w') as file:
             file.write(self.model)
+        self.read_crystal_file()
 
     def generate_matrix(self):
-        self.read_crystal_file()
-        matrix = []
-        for line in self:
-            matrix.append(line)
-        matrix = np.flip(np.array(matrix), 0)
+        # the model file is only parsed again when it changed on disk
+        if os.path.getmtime(f'{self.name}_crystal_model.txt') != self.file_mtime:
+            self.read_crystal_file()
+
+        if self.matrix_version != self.version:
+            matrix = []
+            for line in self:
+                matrix.append(line)
+            self.matrix = np.flip(np.array(matrix), 0)
+            self.matrix.setflags(write=False)
+            self.matrix_version = self.version
 
-        return matrix
+        return self.matrix
 
 
 class Fdtd(object):
     def __init__(self, name="fdtd_file.fsp"):
+        lumapi = solver.load_lumapi()
         self.fdtd = lumapi.FDTD()
         self.structures = {}
         self.width = 0
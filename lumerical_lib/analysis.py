@@ -0,0 +1,59 @@
+import numpy as np
+
+# Helpers for band structure runs: a section that is a repetition of one
+# supercell along x only needs that supercell between Bloch boundaries.
+
+
+def cell_signature(crystal):
+    # per cell code that decides its geometry (symbol and bend orientation),
+    # sources and monitors read as empty cells
+    cells = crystal.fingerprint()['cells'].copy()
+    ports = np.isin(crystal.grid, crystal.type_codes('source', 'monitor'))
+    cells[ports] = ord('.')*16
+    return cells
+
+
+def row_autocorrelation(cells):
+    # fraction of cells equal to the cell p columns to their right, for
+    # p = 0 .. columns - 1
+    cols = cells.shape[1]
+    match = np.ones(cols)
+    for p in range(1, cols):
+        match[p] = (cells[:, p:] == cells[:, :-p]).mean()
+    return match
+
+
+def find_supercell(crystal):
+    # smallest number of columns repeating over the whole crystal, None if
+    # the crystal is not periodic along x. A period has to fit at least twice
+    # (as in Crystal.fundamental_domain): for a larger shift only a few
+    # columns at the end are compared, which says nothing about periodicity.
+    match = row_autocorrelation(cell_signature(crystal))
+    cols = len(match)
+    periods = np.nonzero(match[1:cols//2 + 1] == 1)[0]
+    if not len(periods):
+        return None
+    return int(periods[0]) + 1
+
+
+def free_sites(crystal, xmin, xmax, n, seed=0, clearance=0.05):
+    # n random (x, y) points of the dielectric inside [xmin, xmax] and the
+    # lattice rows, at least clearance*a away from any hole (crystal
+    # coordinates). Seeded, so a sweep places them at the same points. May
+    # return fewer points when the region has almost no dielectric.
+    a = crystal.a
+    h = a*np.sqrt(3)/2
+    table = crystal.hole_table()
+    table = table[(table['radius'] > 0) & (table['x'] > xmin - a) & (table['x'] < xmax + a)]
+
+    rng = np.random.default_rng(seed)
+    sites = np.zeros((0, 2))
+    for __attempt in range(100):
+        if len(sites) >= n:
+            break
+        points = np.column_stack([rng.uniform(xmin, xmax, 4*n),
+                                  rng.uniform(0, (crystal.y - 1)*h, 4*n)])
+        d = np.hypot(points[:, None, 0] - table['x'], points[:, None, 1] - table['y'])
+        free = (d > table['radius'] + clearance*a).all(axis=1)
+        sites = np.concatenate([sites, points[free]])
+    return sites[:n]
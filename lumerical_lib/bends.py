@@ -0,0 +1,199 @@
+import numpy as np
+
+# Polygons of the 'c' (curve) and 'j' (junction) cells.
+#
+# The shape of a bend only depends on its kind, hole radius, lattice constant
+# and orientation, so every variant is computed once and kept in TEMPLATES.
+# A template holds the vertices, relative to the cell center, and the offset
+# of the companion types['2'] circle that rounds the inner corner.
+#
+# Curve orientations follow the neighbour checks of the bend cell:
+#   0 - no empty neighbour, base shape
+#   1 - (r+1, c-1) and (r+1, c) empty: 60° to 0°, point inside the curve
+#   2 - (r+1, c) and (r+1, c+1) empty: -60° to 0°, point outside the curve
+#   3 - (r-1, c-1) and (r-1, c) empty: -60° to 0°, point inside the curve
+#   4 - (r-1, c) and (r-1, c+1) empty: 60° to 0°, point outside the curve
+#   5 - (r+1, c-1) empty: to 60°, point outside the curve
+#   6 - (r+1, c+1) empty: to -60°, point inside the curve
+#   7 - (r-1, c-1) empty: to -60°, point outside the curve
+#   8 - (r-1, c+1) empty: to 60°, point inside the curve
+# Junction orientations:
+#   0 - (r+1, c-1) is a '1' hole (or neither neighbour is)
+#   1 - (r-1, c-1) is a '1' hole, mirrored about the x axis
+
+CURVE_ORIENTATIONS = 9
+JUNCTION_ORIENTATIONS = 2
+
+# (row offset, column offset) of every neighbour checked above
+NEIGHBOURS = [(1, -1), (1, 0), (1, 1), (-1, -1), (-1, 0), (-1, 1)]
+
+TEMPLATES = {}
+
+
+def curve_vertices(r, a):
+    h = a*np.sqrt(3)/2
+    return [
+        (0, r),
+        (a, r),
+        (2.5*a + np.cos(np.deg2rad(120)) * r,
+            h + np.sin(np.deg2rad(120))*r),
+        (3*a + np.cos(np.deg2rad(150))*r,
+            2*h + np.sin(np.deg2rad(150))*r),
+        (3*a + np.cos(np.deg2rad(-30))*r,
+            2*h + np.sin(np.deg2rad(-30))*r),
+        (2.5*a + np.cos(np.deg2rad(-30))*r,
+            h + np.sin(np.deg2rad(-30))*r),
+        (2.5*a + np.cos(np.deg2rad(-60))*r,
+            h + np.sin(np.deg2rad(-60))*r),
+        (a + np.cos(np.deg2rad(-60))*r,
+            np.sin(np.deg2rad(-60))*r),
+        (a, -r),
+        (0, -r)
+    ]
+
+
+def junction_vertices(r, a):
+    h = a*np.sqrt(3)/2
+    return [
+        (np.cos(np.deg2rad(30))*r, np.sin(np.deg2rad(30))*r),
+        (0.5*a + np.cos(np.deg2rad(30)) *
+            r, -h + np.sin(np.deg2rad(30))*r),
+        (2*a + np.cos(np.deg2rad(60))*r, -
+            2*h + np.sin(np.deg2rad(60))*r),
+        (2*a + np.cos(np.deg2rad(240))*r, -
+            2*h + np.sin(np.deg2rad(240))*r),
+        (0.5*a + np.cos(np.deg2rad(240)) *
+            r, -h + np.sin(np.deg2rad(240))*r),
+        (0.5*a + np.cos(np.deg2rad(210)) *
+            r, -h + np.sin(np.deg2rad(210))*r),
+        (np.cos(np.deg2rad(210))*r, np.sin(np.deg2rad(210))*r)
+    ]
+
+
+def transform(vtx, sx, ox, sy, oy):
+    # (sx*x + ox, sy*y + oy), with sx and sy in {1, -1}
+    vtx = np.asarray(vtx, dtype=np.float64)
+    return np.column_stack([sx*vtx[:, 0] + ox, sy*vtx[:, 1] + oy])
+
+
+def build_templates(kind, r, a):
+    h = a*np.sqrt(3)/2
+
+    if kind == 'curve':
+        vtx = curve_vertices(r, a)
+        x_desv = np.cos(np.deg2rad(-60))*a*1/3
+        y_desv = np.sin(np.deg2rad(-60))*a*1/3
+
+        # (sx, ox, sy, oy) of the vertices and (sx, sy) of the companion
+        variants = [
+            ((1, 0, 1, 0), (1, 1)),
+            ((-1, 1.5*a, -1, h), (1, 1)),
+            ((-1, 2*a, 1, 0), (-1, 1)),
+            ((-1, 1.5*a, 1, -h), (1, -1)),
+            ((-1, 2*a, -1, 0), (-1, -1)),
+            ((1, -2*a, 1, 0), (1, 1)),
+            ((1, -1.5*a, -1, h), (-1, 1)),
+            ((1, -2*a, -1, 0), (1, -1)),
+            ((1, -1.5*a, 1, -h), (-1, -1)),
+        ]
+    else:
+        vtx = transform(junction_vertices(r, a), 1, -1.5*a, 1, h)
+        x_desv = np.cos(np.deg2rad(60))*a*1/3
+        y_desv = np.sin(np.deg2rad(60))*a*1/3
+
+        variants = [
+            ((1, 0, 1, 0), (1, 1)),
+            ((1, 0, -1, 0), (1, -1)),
+        ]
+
+    for orientation, (vertex_map, (cx, cy)) in enumerate(variants):
+        vertices = transform(vtx, *vertex_map)
+        vertices.setflags(write=False)
+        TEMPLATES[(kind, r, a, orientation)] = (
+            vertices, (cx*x_desv, cy*y_desv))
+
+
+def orientations(grid, curve_codes, junction_codes, border=' '):
+    # Orientation code of every curve/junction cell of a symbol grid at once,
+    # -1 everywhere else. Cells outside the grid are read as the border
+    # symbol, so bends at the edges are classified like any other cell.
+    rows, cols = grid.shape
+    padded = np.pad(grid, 1, constant_values=ord(border))
+    empty = padded == ord('.')
+    one = padded == ord('1')
+
+    def at(mask, dr, dc):
+        return mask[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+
+    e = {offset: at(empty, *offset) for offset in NEIGHBOURS}
+    curve = np.select([
+        e[(1, -1)] & e[(1, 0)],
+        e[(1, 0)] & e[(1, 1)],
+        e[(-1, -1)] & e[(-1, 0)],
+        e[(-1, 0)] & e[(-1, 1)],
+        e[(1, -1)],
+        e[(1, 1)],
+        e[(-1, -1)],
+        e[(-1, 1)],
+    ], [1, 2, 3, 4, 5, 6, 7, 8], default=0)
+    junction = np.where(~at(one, 1, -1) & at(one, -1, -1), 1, 0)
+
+    codes = np.full(grid.shape, -1, dtype=np.int8)
+    is_curve = np.isin(grid, curve_codes)
+    is_junction = np.isin(grid, junction_codes)
+    codes[is_curve] = curve[is_curve]
+    codes[is_junction] = junction[is_junction]
+    return codes
+
+
+def bend_template(kind, r, a, orientation):
+    # -> (vertices, (x_desv, y_desv)) for a bend of hole radius r
+    key = (kind, r, a, orientation)
+    if key not in TEMPLATES:
+        build_templates(kind, r, a)
+    return TEMPLATES[key]
+
+
+class BendLibrary(object):
+    # Collects the bends of a structure group so that each distinct polygon
+    # is defined once in the solver (bend_<n> = [vertices]) and a placement
+    # is just one (x, y) row of the matrix walked by that polygon's loop.
+    # Mirrored orientations are separate templates, a polygon rotation can
+    # not produce them, so a group needs at most CURVE_ORIENTATIONS +
+    # JUNCTION_ORIENTATIONS definitions per bend radius.
+    def __init__(self, zspan, material='etch'):
+        self.zspan = zspan
+        self.material = material
+        self.templates = {}
+        self.placements = {}
+
+    def __len__(self):
+        return sum(len(at) for at in self.placements.values())
+
+    def place(self, key, vertices, x, y):
+        if key not in self.templates:
+            name = f'bend_{len(self.templates)}'
+            self.templates[key] = (name, vertices)
+            self.placements[name] = []
+        name = self.templates[key][0]
+        self.placements[name].append((x, y))
+        return name
+
+    def iter_script(self):
+        for name, vertices in self.templates.values():
+            yield '{} = [{}]; \n'.format(name, ';'.join(
+                f'{x},{y}' for x, y in vertices.tolist()))
+        yield '\n'
+
+        for name, at in self.placements.items():
+            yield ('{0}_at = [{1}]; \n'
+                   'for(i = 1:{2}) {{ \n'
+                   'addpoly; \n'
+                   'set("x", {0}_at(i, 1)); \n'
+                   'set("y", {0}_at(i, 2)); \n'
+                   'set("vertices", {0}); \n'
+                   'set("z span", {3}); \n'
+                   'set("material", "{4}"); \n'
+                   '}} \n\n').format(
+                       name, ';'.join(f'{x},{y}' for x, y in at), len(at),
+                       self.zspan, self.material)
@@ -0,0 +1,93 @@
+import hashlib
+import os
+
+from lumerical_lib import crystal as crystal_module
+
+# Structure scripts on disk, addressed by a hash of everything that shapes
+# them: the model text, a, zspan, border, the types table, the emission
+# options and crystal.SCRIPT_VERSION. Entries are plain .lsf files; reading
+# one touches its mtime, and once the directory grows past max_bytes the
+# least recently used ones are removed.
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lumerical_lib')
+
+
+class ScriptCache(object):
+    def __init__(self, path=None, max_bytes=512*2**20):
+        self.path = path or os.environ.get('LUMERICAL_LIB_CACHE', DEFAULT_DIR)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, crystal, **options):
+        parts = (crystal.model, crystal.a, crystal.zspan, crystal.border,
+                 sorted((simbol, sorted(type.items()))
+                        for simbol, type in crystal_module.types.items()),
+                 sorted(options.items()), crystal_module.SCRIPT_VERSION)
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, f'{key}.lsf')
+
+    def get(self, key):
+        try:
+            with open(self.file(key)) as file:
+                script = file.read()
+        except FileNotFoundError:
+            return None
+        os.utime(self.file(key))
+        return script
+
+    def put(self, key, script):
+        # written under a temporary name first, readers never see half a file
+        tmp = f'{self.file(key)}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as file:
+            file.write(script)
+        os.replace(tmp, self.file(key))
+        self.evict()
+
+    def script(self, crystal, **options):
+        # generate_script(**options) of the crystal, from the cache if present
+        key = self.key(crystal, **options)
+        script = self.get(key)
+        if script is None:
+            self.misses += 1
+            script = crystal.generate_script(**options)
+            self.put(key, script)
+        else:
+            self.hits += 1
+        return script
+
+    def entries(self):
+        # (mtime, size, path) of every entry, oldest first
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.lsf'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for __mtime, size, __path in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for __mtime, size, __path in entries)
+        for __mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for __mtime, __size, path in self.entries():
+            os.remove(path)
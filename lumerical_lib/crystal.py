@@ -2,6 +2,9 @@ import numpy as np
 import os
 import shutil
 
+from lumerical_lib import validate
+from lumerical_lib.bends import BendLibrary, bend_template, orientations
+
 types = {
     '0': {'type': 'circle', 'radius': 0.30},
     '1': {'type': 'circle', 'radius': 0.38},
@@ -16,19 +19,58 @@ types = {
     'm': {'type': 'monitor'}
 }
 
+# Each cell of the lattice is stored as the ASCII code of its symbol, so the
+# grid is a plain uint8 array. PAD fills the tail of rows shorter than the
+# widest one and is never a valid symbol.
+PAD = ord(' ')
+
+# bumped whenever the output of iter_script changes, part of the key of the
+# script cache (lumerical_lib.cache)
+SCRIPT_VERSION = 1
+
+
+def types_key():
+    # kind and radius of every symbol of the types table, the part of it that
+    # shapes the geometry; stamps the cached hole table next to the version
+    return tuple((simbol, type['type'], type.get('radius')) for simbol, type in types.items())
+
+
+HOLE_DTYPE = np.dtype([('x', np.float64), ('y', np.float64),
+                       ('radius', np.float64), ('code', np.uint8),
+                       ('row', np.intp), ('col', np.intp)])
+
 
 class Crystal(object):
-    def __init__(self, name, a=0.426E-6, zspan=0.40E-6):
+    def __init__(self, name, a=0.426E-6, zspan=0.40E-6, model=None, strict=False):
         self.name = name
         self.x = 0
         self.y = 0
-        self.model = ""
+        # grid[rindex, cindex], rindex = 0 is the bottom row (last line of the file)
+        self.grid = np.zeros((0, 0), dtype=np.uint8)
+        # shift[rindex] is True for the rows displaced by a/2
+        self.shift = np.zeros(0, dtype=bool)
         self.first_null = False
+        # bumped on every edit of the grid, stamps the cached matrix
+        self.version = 0
+        self.matrix = None
+        self.matrix_version = -1
+        self.table = None
+        self.table_key = None
+        self.symmetry_cache = None
+        self.symmetry_version = -1
         self.a = a
         self.zspan = zspan
         self.x_init = 0
-
-        if os.path.exists(f'{self.name}_crystal_model.txt'):
+        # symbol assumed beyond the edges of the lattice when classifying bends
+        self.border = ' '
+        # a model file with overlapping or clipped holes raises instead of
+        # only being logged, see check()
+        self.strict = strict
+
+        if model is not None:
+            # built in memory, the model file is not touched
+            self.set_model(model)
+        elif os.path.exists(f'{self.name}_crystal_model.txt'):
             self.read_crystal_file()
             print(
                 f'[log] Modelo atualizado com base no arquivo {self.name}_crystal_model.txt')
@@ -46,19 +88,56 @@ class Crystal(object):
 
     def __next__(self):
         if self.iter_aux < self.y:
-            line = self.model.splitlines()[self.iter_aux].split()
+            line = self.row_symbols(self.y - 1 - self.iter_aux)
             self.iter_aux = self.iter_aux + 1
             return line
         else:
             raise StopIteration
 
+    @property
+    def model(self):
+        return self.grid_to_model(self.grid, self.shift)
+
+    @staticmethod
+    def model_to_grid(model):
+        lines = [line for line in model.splitlines() if line and not line.isspace()]
+        if not lines:
+            return np.zeros((0, 0), dtype=np.uint8), False
+
+        rows = [line.split() for line in lines]
+        for row in rows:
+            for simbol in row:
+                if len(simbol) != 1 or not simbol.isascii():
+                    raise ValueError(f'Simbolo invalido no modelo: {simbol!r}')
+
+        grid = np.full((len(rows), max(len(row) for row in rows)), PAD,
+                       dtype=np.uint8)
+        for rindex, row in enumerate(reversed(rows)):
+            grid[rindex, :len(row)] = np.frombuffer(
+                ''.join(row).encode('ascii'), dtype=np.uint8)
+
+        first_null = lines[-1][0] == ' '
+        return grid, first_null
+
+    @staticmethod
+    def grid_to_model(grid, shift):
+        model = ''
+        for rindex in range(grid.shape[0] - 1, -1, -1):
+            line = ' '.join(grid[rindex].tobytes().decode('ascii').rstrip())
+            model += ' ' + line + '\n' if shift[rindex] else line + ' \n'
+        return model
+
+    def row_symbols(self, rindex):
+        return list(self.grid[rindex].tobytes().decode('ascii').rstrip())
+
+    def row_lengths(self):
+        # PAD only appears at the end of a row
+        return (self.grid != PAD).sum(axis=1)
+
     def generate_crystal_file(self, x=5, y=5):
-        self.model = ""
-        for row in range(y):
-            tmp_row = row + 1 if not ((y % 2 == 1) == self.first_null) else row
-            for col in range(x):
-                self.model += " 0" if tmp_row % 2 == 0 else "0 "
-            self.model += "\n"
+        self.grid = np.full((y, x), ord('0'), dtype=np.uint8)
+        self.set_size()
+        model = self.model
 
         if os.path.exists(f'{self.name}_crystal_model.txt'):
             i = 1
@@ -75,256 +154,483 @@ class Crystal(object):
             print("[log] Arquivo antigo salvo em backup")
 
         with open(f'{self.name}_crystal_model.txt', 'w') as file:
-            file.write(self.model)
+            file.write(model)
 
     def read_crystal_file(self):
-        self.model = ''
-        tmp_model = ''
         with open(f'{self.name}_crystal_model.txt') as file:
             tmp_model = file.read()
 
-        tmp_model += '\n'
-        for line in tmp_model.splitlines(keepends=True):
-            if line.isspace():
-                continue
-            self.model += line
-
-        self.set_size()
-        if self.model.splitlines()[-1][0] == ' ':
+        self.grid, first_null = self.model_to_grid(tmp_model)
+        if first_null:
             self.first_null = True
+        self.set_size()
+        self.check()
+
+    def check(self, margin=validate.MARGIN):
+        # geometry conflicts of the current grid, see lumerical_lib.validate
+        conflicts = validate.check(self, margin)
+        for conflict in conflicts:
+            print(f'[log] {self.name}: {validate.describe(conflict)}')
+        if conflicts and self.strict:
+            raise ValueError(
+                f'{self.name}: {len(conflicts)} conflitos de geometria no modelo')
+        return conflicts
 
     def expand_x(self, n=1):
-        tmp_model = self.model
-        self.model = ''
-        for line in tmp_model.splitlines():
-            for __n in range(n):
-                line += line[-2:]
-            line += '\n'
-            self.model += line
+        lengths = self.row_lengths()
+        rows = np.arange(self.y)
+        grid = np.full((self.y, lengths.max() + n), PAD, dtype=np.uint8)
+        grid[:, :self.x] = self.grid
+        last = self.grid[rows, lengths - 1]
+        for __n in range(n):
+            grid[rows, lengths + __n] = last
+        self.grid = grid
         self.set_size()
 
     def reduce_x(self, n=1):
-        tmp_model = self.model
-        self.model = ''
-        for line in tmp_model.splitlines():
-            for __n in range(n):
-                line = line[:-2]
-            line += '\n'
-            self.model += line
+        lengths = np.maximum(self.row_lengths() - n, 0)
+        grid = self.grid[:, :lengths.max()].copy()
+        grid[np.arange(grid.shape[1]) >= lengths[:, None]] = PAD
+        self.grid = grid
         self.set_size()
 
-    def generate_script(self):
-        script = 'deleteall; \n\n'
+    def type_codes(self, *kinds):
+        return [ord(simbol) for simbol, type in types.items()
+                if type['type'] in kinds]
+
+    def hole_table(self):
+        # One record per cell holding a symbol of the types table (except
+        # 'none'), in row-major order. x and y are the cell centers relative
+        # to the crystal origin and radius is already scaled by a (0 for
+        # sources and monitors). The table is cached like the matrix, and
+        # built again when a or the types table change.
+        key = (self.version, self.a, types_key())
+        if self.table_key == key:
+            return self.table
+
         a = self.a
-        zspan = self.zspan
         h = a*np.sqrt(3)/2
 
-        matrix = self.generate_matrix()
+        radius = np.zeros(256)
+        used = np.zeros(256, dtype=bool)
+        for simbol, type in types.items():
+            if type['type'] == 'none':
+                continue
+            used[ord(simbol)] = True
+            radius[ord(simbol)] = a * type.get('radius', 0)
+
+        rows, cols = np.nonzero(used[self.grid])
+        codes = self.grid[rows, cols]
+
+        table = np.empty(len(rows), dtype=HOLE_DTYPE)
+        # odd rows are displaced by a/2, row parity broadcast through shift
+        table['x'] = np.where(self.shift[rows], cols*a + a/2, cols*a)
+        table['y'] = rows*h
+        table['radius'] = radius[codes]
+        table['code'] = codes
+        table['row'] = rows
+        table['col'] = cols
+        table.setflags(write=False)
+
+        self.table = table
+        self.table_key = key
+        return table
+
+    def ports(self, kind):
+        # x and y arrays of the 'source' or 'monitor' cells, in row-major
+        # order and in simulation coordinates (x_init included)
+        table = self.hole_table()
+        sites = table[np.isin(table['code'], self.type_codes(kind))]
+        return sites['x'] + self.x_init, sites['y'].copy()
+
+    def bends(self):
+        # One entry per curve/junction cell in row-major order:
+        # (x, y, vertices, companion x, companion y, companion radius, key).
+        # The vertices are relative to (x, y), the companion circle is the
+        # types['2'] hole that rounds the inner corner of the bend and key
+        # identifies the template in lumerical_lib.bends.
+        a = self.a
 
-        for rindex, row in enumerate(matrix):
-            for cindex, simbol in enumerate(row):
-                if simbol not in types.keys():
-                    continue
-                type = types[simbol]
+        table = self.hole_table()
+        cells = table[np.isin(table['code'], self.type_codes('curve', 'junction'))]
+        circle_radius = a * types['2']['radius']
+
+        orientation = self.bend_orientations()[cells['row'], cells['col']]
+
+        bends = []
+        for x, y, radius, code, orientation in zip(
+                cells['x'].tolist(), cells['y'].tolist(), cells['radius'].tolist(),
+                cells['code'].tolist(), orientation.tolist()):
+            kind = types[chr(code)]['type']
+            key = (kind, radius, a, orientation)
+            vtx, (x_desv, y_desv) = bend_template(*key)
+            bends.append((x, y, vtx, x + x_desv, y + y_desv, circle_radius, key))
+        return bends
+
+    def bend_orientations(self):
+        # orientation code of every 'c'/'j' cell, see lumerical_lib.bends
+        return orientations(self.grid, self.type_codes('curve'),
+                            self.type_codes('junction'), self.border)
+
+    def circle_table(self):
+        # every circle of the crystal, lattice holes and bend companions,
+        # as an (n, 3) array of x, y, radius
+        table = self.hole_table()
+        circles = table[np.isin(table['code'], self.type_codes('circle'))]
+        companions = [bend[3:6] for bend in self.bends()]
+        return np.concatenate([
+            np.column_stack([circles['x'], circles['y'], circles['radius']]),
+            np.array(companions, dtype=np.float64).reshape(-1, 3)])
+
+    def iter_script(self, compact=False, circles=True, symmetry=False):
+        # Yields the structure group script one object at a time.
+        # compact: circles are grouped by radius and emitted at the end as
+        # coordinate matrices walked by a Lumerical for loop, bends are
+        # instanced from a BendLibrary.
+        # circles=False leaves every circle out, for when they are sent to
+        # the solver by other means (see Fdtd.add_crystal).
+        # symmetry (implies compact): only the lattice circles of the
+        # fundamental domain are sent, the loops replicate them, see
+        # symmetry() and fundamental_domain().
+        yield 'deleteall; \n\n'
+        zspan = self.zspan
+        compact = compact or symmetry
+        if symmetry:
+            copies, mirror, axis, period = self.fundamental_domain()
+
+        lattice_circles = {}
+        free_circles = {}
+        library = BendLibrary(zspan)
 
-                if type['type'] == 'none':
+        table = self.hole_table()
+        geometry = table[np.isin(table['code'],
+                                 self.type_codes('circle', 'curve', 'junction'))]
+        bends = iter(self.bends())
+
+        for x, y, radius, code, rindex, cindex in geometry.tolist():
+            type = types[chr(code)]
+
+            if type['type'] == 'circle':
+                if not circles:
+                    continue
+                if symmetry:
+                    # the columns of the symmetries in use, see iter_circle_loops
+                    if copies[rindex, cindex]:
+                        lattice_circles.setdefault(radius, []).append(
+                            (cindex, rindex, int(self.shift[rindex]))
+                            + ((int(copies[rindex, cindex]),) if period else ())
+                            + ((int(mirror[rindex, cindex]),) if axis is not None else ()))
+                    continue
+                if compact:
+                    lattice_circles.setdefault(radius, []).append(
+                        (cindex, rindex, int(self.shift[rindex])))
                     continue
-                elif type['type'] == 'circle':
-                    script += 'addcircle; \n'
-
-                    script += 'set("radius", {}); \n'.format(a *
-                                                             type['radius'])
-                    if not (rindex % 2 == 1) == self.first_null:  # odd
-                        script += 'set("x", {}); \n'.format(cindex*a + a/2)
-                    else:  # even
-                        script += 'set("x", {}); \n'.format(cindex*a)
-                    script += 'set("y", {}); \n'.format(rindex*h)
-
-                    script += 'set("z", {}); \n'.format(0)
-                    script += 'set("z span", {}); \n'.format(zspan)
-                    script += 'set("material", "{}"); \n'.format('etch')
-                    script += '\n'
-                elif type['type'] == 'curve':
-                    script += 'addpoly; \n'
-                    r = a * type['radius']
-                    vtx = [
-                        (0, r),
-                        (a, r),
-                        (2.5*a + np.cos(np.deg2rad(120)) * r,
-                            h + np.sin(np.deg2rad(120))*r),
-                        (3*a + np.cos(np.deg2rad(150))*r,
-                            2*h + np.sin(np.deg2rad(150))*r),
-                        (3*a + np.cos(np.deg2rad(-30))*r,
-                            2*h + np.sin(np.deg2rad(-30))*r),
-                        (2.5*a + np.cos(np.deg2rad(-30))*r,
-                            h + np.sin(np.deg2rad(-30))*r),
-                        (2.5*a + np.cos(np.deg2rad(-60))*r,
-                            h + np.sin(np.deg2rad(-60))*r),
-                        (a + np.cos(np.deg2rad(-60))*r,
-                            np.sin(np.deg2rad(-60))*r),
-                        (a, -r),
-                        (0, -r)
-                    ]
-
-                    circle_script = 'addcircle; \n\n'
-                    circle_type = types['2']
-                    circle_script += 'set("radius", {}); \n'.format(a *
-                                                                    circle_type['radius'])
-                    circle_script += 'set("z", {}); \n'.format(0)
-                    circle_script += 'set("z span", {}); \n'.format(zspan)
-                    circle_script += 'set("material", "{}"); \n'.format('etch')
-
-                    x_desv = np.cos(np.deg2rad(-60))*a*1/3
-                    y_desv = np.sin(np.deg2rad(-60))*a*1/3
-
-                    ri = rindex
-                    ci = cindex
-
-                    # print(ri, ci)
-                    # print(matrix[ri-1:ri+2], '\n')
-
-                    if matrix[ri+1][ci-1] == '.' and matrix[ri+1][ci-0] == '.':
-                        # print("curva de 60° para 0° com ponto interno a curva")
-                        vtx = [(-x[0] + 1.5*a, -x[1] + h) for x in vtx]
-                    elif matrix[ri+1][ci-0] == '.' and matrix[ri+1][ci+1] == '.':
-                        # print("curva de -60° para 0° com ponto externo a curva")
-                        vtx = [(-x[0] + 2*a, x[1]) for x in vtx]
-                        x_desv *= -1
-                    elif matrix[ri-1][ci-1] == '.' and matrix[ri-1][ci-0] == '.':
-                        # print("curva de -60° para 0° com ponto interno a curva")
-                        vtx = [(-x[0] + 1.5*a, x[1] - h) for x in vtx]
-                        y_desv *= -1
-                    elif matrix[ri-1][ci-0] == '.' and matrix[ri-1][ci+1] == '.':
-                        # print("curva de 60° para 0° com ponto externo a curva")
-                        vtx = [(-x[0] + 2*a, -x[1]) for x in vtx]
-                        x_desv *= -1
-                        y_desv *= -1
-                    elif matrix[ri+1][ci-1] == '.':
-                        # print("curva para 60° com ponto externo a curva")
-                        vtx = [(x[0] - 2*a, x[1]) for x in vtx]
-                    elif matrix[ri+1][ci+1] == '.':
-                        # print("curva para -60° com ponto interno a curva")
-                        vtx = [(x[0] - 1.5*a, -x[1] + h) for x in vtx]
-                        x_desv *= -1
-                    elif matrix[ri-1][ci-1] == '.':
-                        # print("curva para -60° com ponto externo a curva")
-                        vtx = [(x[0] - 2*a, -x[1]) for x in vtx]
-                        y_desv *= -1
-                    elif matrix[ri-1][ci+1] == '.':
-                        # print("curva para 60° com ponto interno a curva")
-                        vtx = [(x[0] - 1.5*a, x[1] - h) for x in vtx]
-                        x_desv *= -1
-                        y_desv *= -1
-
-                    if not (ri % 2 == 1) == self.first_null:  # odd
-                        circle_script += 'set("x", {}); \n'.format(cindex *
-                                                                   a + a/2 + x_desv)
-                    else:  # even
-                        circle_script += 'set("x", {}); \n'.format(cindex *
-                                                                   a + x_desv)
-                    circle_script += 'set("y", {}); \n'.format(rindex*h + y_desv)
-
-                    vertices = '['
-                    for i, point in enumerate(vtx):
-                        if i != 0:
-                            vertices += ';'
-                        vertices += f'{point[0]},{point[1]}'
-                    vertices += ']'
-
-                    if not (rindex % 2 == 1) == self.first_null:  # odd
-                        script += 'set("x", {}); \n'.format(cindex*a + a/2)
-                    else:  # even
-                        script += 'set("x", {}); \n'.format(cindex*a)
-                    script += 'set("y", {}); \n'.format(rindex*h)
-
-                    script += 'set("vertices", {});'.format(vertices)
-                    script += 'set("z span", {}); \n'.format(zspan)
-                    script += 'set("material", "{}"); \n'.format('etch')
-
-                    script += circle_script
-                    script += '\n'
-                elif type['type'] == 'junction':
-                    script += 'addpoly; \n'
-                    r = a * type['radius']
-                    vtx = [
-                        (np.cos(np.deg2rad(30))*r, np.sin(np.deg2rad(30))*r),
-                        (0.5*a + np.cos(np.deg2rad(30)) *
-                            r, -h + np.sin(np.deg2rad(30))*r),
-                        (2*a + np.cos(np.deg2rad(60))*r, -
-                            2*h + np.sin(np.deg2rad(60))*r),
-                        (2*a + np.cos(np.deg2rad(240))*r, -
-                            2*h + np.sin(np.deg2rad(240))*r),
-                        (0.5*a + np.cos(np.deg2rad(240)) *
-                            r, -h + np.sin(np.deg2rad(240))*r),
-                        (0.5*a + np.cos(np.deg2rad(210)) *
-                            r, -h + np.sin(np.deg2rad(210))*r),
-                        (np.cos(np.deg2rad(210))*r, np.sin(np.deg2rad(210))*r)
-                    ]
-
-                    circle_script = 'addcircle; \n\n'
-                    circle_type = types['2']
-                    circle_script += 'set("radius", {}); \n'.format(a *
-                                                                    circle_type['radius'])
-                    circle_script += 'set("z", {}); \n'.format(0)
-                    circle_script += 'set("z span", {}); \n'.format(self.zspan)
-                    circle_script += 'set("material", "{}"); \n'.format('etch')
-
-                    x_desv = np.cos(np.deg2rad(60))*a*1/3
-                    y_desv = np.sin(np.deg2rad(60))*a*1/3
-
-                    vtx = [(x[0] - 1.5*a, x[1] + h) for x in vtx]
-
-                    if matrix[rindex+1][cindex-1] == '1':
-                        pass
-                    elif matrix[rindex-1][cindex-1] == '1':
-                        vtx = [(x[0], -x[1]) for x in vtx]
-                        y_desv *= -1
-
-                    if not (rindex % 2 == 1) == self.first_null:  # odd
-                        circle_script += 'set("x", {}); \n'.format(cindex *
-                                                                   a + a/2 + x_desv)
-                    else:  # even
-                        circle_script += 'set("x", {}); \n'.format(cindex*a + x_desv)
-                    circle_script += 'set("y", {}); \n'.format(rindex*h + y_desv)
-
-                    vertices = '['
-                    for i, point in enumerate(vtx):
-                        if i != 0:
-                            vertices += ';'
-                        vertices += f'{point[0]},{point[1]}'
-                    vertices += ']'
-
-                    if not (rindex % 2 == 1) == self.first_null:  # odd
-                        script += 'set("x", {}); \n'.format(cindex*a + a/2)
-                    else:  # even
-                        script += 'set("x", {}); \n'.format(cindex*a)
-
-                    script += 'set("y", {}); \n'.format(rindex*h)
-
-                    script += 'set("vertices", {});'.format(vertices)
-                    script += 'set("z span", {}); \n'.format(self.zspan)
-                    script += 'set("material", "{}"); \n'.format('etch')
-
-                    script += circle_script
-
-                    script += '\n'
-                else:
+
+                yield ('addcircle; \n'
+                       'set("radius", {}); \n'
+                       'set("x", {}); \n'
+                       'set("y", {}); \n'
+                       'set("z", {}); \n'
+                       'set("z span", {}); \n'
+                       'set("material", "{}"); \n'
+                       '\n').format(radius, x, y, 0, zspan, 'etch')
+            else:
+                x, y, vtx, circle_x, circle_y, circle_radius, key = next(bends)
+
+                if compact:
+                    library.place(key, vtx, x, y)
+                    if circles:
+                        free_circles.setdefault(circle_radius, []).append(
+                            (circle_x, circle_y))
                     continue
+
+                vertices = '[' + ';'.join(
+                    f'{point[0]},{point[1]}' for point in vtx) + ']'
+
+                chunk = ('addpoly; \n'
+                         'set("x", {}); \n'
+                         'set("y", {}); \n'
+                         'set("vertices", {});'
+                         'set("z span", {}); \n'
+                         'set("material", "{}"); \n').format(
+                             x, y, vertices, zspan, 'etch')
+
+                if circles:
+                    chunk += ('addcircle; \n\n'
+                              'set("radius", {}); \n'
+                              'set("z", {}); \n'
+                              'set("z span", {}); \n'
+                              'set("material", "{}"); \n'
+                              'set("x", {}); \n'
+                              'set("y", {}); \n').format(
+                                  circle_radius, 0, zspan, 'etch',
+                                  circle_x, circle_y)
+                yield chunk + '\n'
+
+        if compact:
+            yield from library.iter_script()
+        if compact and circles:
+            yield from self.iter_circle_loops(
+                lattice_circles, free_circles,
+                symmetry=(axis, period) if symmetry else None)
+
+    def generate_script(self, compact=False, circles=True, symmetry=False):
+        return ''.join(self.iter_script(compact=compact, circles=circles,
+                                        symmetry=symmetry))
+
+    def write_script(self, path, compact=False, circles=True, symmetry=False):
+        # streams the script to a .lsf file without building it in memory
+        with open(path, 'w') as file:
+            for chunk in self.iter_script(compact=compact, circles=circles,
+                                          symmetry=symmetry):
+                file.write(chunk)
+
+    def symmetry(self):
+        # (axis, reach, period) of the lattice circles, cached like the matrix.
+        # Rows axis - reach .. axis + reach are mirrored about row axis (axis
+        # is None when no two rows are), the band with the largest reach
+        # wins. Every column repeats period columns to its right (None when
+        # the grid is not periodic). Rows 2k apart share their shift, so the
+        # mirror or translated image of a hole is the same hole at the image
+        # cell. Bends and their companions are not part of it.
+        if self.symmetry_version == self.version:
+            return self.symmetry_cache
+
+        circles = np.where(np.isin(self.grid, self.type_codes('circle')), self.grid, 0)
+
+        axis, reach = None, 0
+        for rindex in range(1, self.y - 1):
+            k = min(rindex, self.y - 1 - rindex)
+            if k > reach:
+                band = circles[rindex - k:rindex + k + 1]
+                if np.array_equal(band, band[::-1]):
+                    axis, reach = rindex, k
+
+        period = None
+        for p in range(1, self.x):
+            if np.array_equal(circles[:, p:], circles[:, :-p]):
+                period = p
+                break
+
+        self.symmetry_cache = (axis, reach, period)
+        self.symmetry_version = self.version
+        return self.symmetry_cache
+
+    def fundamental_domain(self):
+        # (copies, mirror, axis, period) for the symmetric script. A cell
+        # with copies > 0 is in the domain and stands for itself and the
+        # copies - 1 cells every period columns to its right; mirror = 1 adds
+        # the image of all of them about row axis. Cells with copies = 0 are
+        # images of domain cells. A symmetry is only used when it drops at
+        # least half of the rows or columns (axis or period None otherwise).
+        axis, reach, period = self.symmetry()
+        if period is not None and 2*period > self.x:
+            period = None
+        if axis is not None and 2*(2*reach + 1) < self.y:
+            axis = None
+
+        copies = np.ones((self.y, self.x), dtype=np.intp)
+        if period is not None:
+            cols = np.arange(self.x)
+            copies[:] = np.where(cols < period, (self.x - cols + period - 1)//period, 0)
+
+        mirror = np.zeros((self.y, self.x), dtype=np.intp)
+        if axis is not None:
+            copies[axis - reach:axis] = 0
+            mirror[axis + 1:axis + reach + 1] = 1
+        return copies, mirror, axis, period
+
+    def mirror_plane(self):
+        # y of the plane the whole crystal (circles, bends, sources and
+        # monitors) is mirror symmetric about, None if there is none
+        h = self.a*np.sqrt(3)/2
+        if self.y % 2 == 0:
+            return None
+        axis = (self.y - 1)//2
+        if not np.array_equal(self.grid, self.grid[::-1]):
+            return None
+
+        # bends are checked on their polygons, their orientation codes are
+        # not mirror images of each other
+        def shapes(sign):
+            # polygons and companions, in units of a, mirrored if sign = -1
+            found = set()
+            for x, y, vtx, cx, cy, cr, __key in self.bends():
+                vx = x + vtx[:, 0]
+                vy = axis*h + sign*(y + vtx[:, 1] - axis*h)
+                cy = axis*h + sign*(cy - axis*h)
+                found.add(tuple(np.round(np.append(vx, vy)/self.a, 9).tolist()))
+                found.add(tuple(np.round(np.array([cx, cy, cr])/self.a, 9).tolist()))
+            return found
+
+        if shapes(1) != shapes(-1):
+            return None
+        return axis*h
+
+    def fingerprint(self):
+        # What decides the objects pushed for this crystal. 'key' holds the
+        # parameters shared by every cell, a change there means a full
+        # rebuild. 'cells' holds, per cell, the symbol code and the bend
+        # orientation, so editing a cell also marks the bends around it.
+        return {
+            'key': (self.a, self.zspan, self.first_null, self.border, types_key()),
+            'cells': self.grid.astype(np.int16)*16 + (self.bend_orientations() + 1)
+        }
+
+    @staticmethod
+    def cell_objects(code, rindex, cindex):
+        # names of the objects iter_cells_script creates for a cell
+        kind = types.get(chr(code), {'type': 'none'})['type']
+        if kind == 'circle':
+            return [f'h_{rindex}_{cindex}']
+        elif kind in ('curve', 'junction'):
+            return [f'b_{rindex}_{cindex}', f'bc_{rindex}_{cindex}']
+        return []
+
+    def iter_cells_script(self, mask=None):
+        # One named object per geometry cell selected by mask (every cell by
+        # default), so the cell can later be replaced on its own.
+        zspan = self.zspan
+        table = self.hole_table()
+        bend_cells = table[np.isin(table['code'], self.type_codes('curve', 'junction'))]
+        bends = dict(zip(zip(bend_cells['row'].tolist(), bend_cells['col'].tolist()),
+                         self.bends()))
+
+        circles = table[np.isin(table['code'], self.type_codes('circle'))]
+        if mask is not None:
+            circles = circles[mask[circles['row'], circles['col']]]
+        for x, y, radius, code, rindex, cindex in circles.tolist():
+            yield ('addcircle; \n'
+                   'set("name", "{}"); \n'
+                   'set("radius", {}); \n'
+                   'set("x", {}); \n'
+                   'set("y", {}); \n'
+                   'set("z", 0); \n'
+                   'set("z span", {}); \n'
+                   'set("material", "etch"); \n').format(
+                       *self.cell_objects(code, rindex, cindex), radius, x, y, zspan)
+
+        for (rindex, cindex), bend in bends.items():
+            if mask is not None and not mask[rindex, cindex]:
+                continue
+            x, y, vtx, circle_x, circle_y, circle_radius, key = bend
+            polygon, companion = self.cell_objects(self.grid[rindex, cindex],
+                                                   rindex, cindex)
+            yield ('addpoly; \n'
+                   'set("name", "{}"); \n'
+                   'set("x", {}); \n'
+                   'set("y", {}); \n'
+                   'set("vertices", [{}]); \n'
+                   'set("z span", {}); \n'
+                   'set("material", "etch"); \n'
+                   'addcircle; \n'
+                   'set("name", "{}"); \n'
+                   'set("radius", {}); \n'
+                   'set("x", {}); \n'
+                   'set("y", {}); \n'
+                   'set("z", 0); \n'
+                   'set("z span", {}); \n'
+                   'set("material", "etch"); \n').format(
+                       polygon, x, y,
+                       ';'.join(f'{px},{py}' for px, py in vtx.tolist()), zspan,
+                       companion, circle_radius, circle_x, circle_y, zspan)
+
+    def holes_script(self, holes='holes'):
+        # walks an (n, 3) matrix of x, y, radius already present in the
+        # solver, e.g. the one produced by circle_table
+        script = 'n = size({}); \n'.format(holes)
+        script += 'for(i = 1:n(1)) { \n'
+        script += 'addcircle; \n'
+        script += 'set("radius", {}(i, 3)); \n'.format(holes)
+        script += 'set("x", {}(i, 1)); \n'.format(holes)
+        script += 'set("y", {}(i, 2)); \n'.format(holes)
+        script += 'set("z", 0); \n'
+        script += 'set("z span", {}); \n'.format(self.zspan)
+        script += 'set("material", "etch"); \n'
+        script += '} \n'
         return script
 
+    def iter_circle_loops(self, lattice_circles, free_circles, rows_per_chunk=1024,
+                          symmetry=None):
+        # Lattice circles are sent as integer (col, row, shift) triples and
+        # their position is rebuilt in the solver with the same operations
+        # used by hole_table, so the geometry is bit for bit the same as the
+        # expanded script. Circles off the lattice go as (x, y) pairs.
+        # With symmetry = (axis, period) the lattice rows also carry the
+        # copies column (if period is not None) and the mirror column (if
+        # axis is not None) of fundamental_domain(), the loop places every
+        # image.
+        a = self.a
+        h = a*np.sqrt(3)/2
+
+        yield 'a = {}; \nh = {}; \nzspan = {}; \n\n'.format(a, h, self.zspan)
+
+        lattice = (lattice_circles, '{},{},{}', '', 'holes(i, 1)*a + holes(i, 3)*(a/2)',
+                   'holes(i, 2)*h', '')
+        if symmetry is not None:
+            axis, period = symmetry
+            row_format, enter, x, y, leave = '{},{},{}', '', lattice[3], lattice[4], ''
+            if period is not None:
+                yield 'period = {}; \n'.format(period)
+                row_format += ',{}'
+                enter += 'for(k = 0:holes(i, 4) - 1) { \n'
+                x = '(holes(i, 1) + k*period)*a + holes(i, 3)*(a/2)'
+                leave += '} \n'
+            if axis is not None:
+                yield 'axis = {}; \n'.format(axis)
+                row_format += ',{}'
+                enter += 'for(m = 0:holes(i, {})) {{ \n'.format(row_format.count('{}'))
+                y = '(axis + (1 - 2*m)*(holes(i, 2) - axis))*h'
+                leave += '} \n'
+            lattice = (lattice_circles, row_format, enter, x, y, leave)
+
+        loops = [lattice,
+                 (free_circles, '{},{}', '', 'holes(i, 1)', 'holes(i, 2)', '')]
+        for groups, row_format, enter, x, y, leave in loops:
+            for radius, holes in groups.items():
+                yield 'r = {}; \nholes = ['.format(radius)
+                for start in range(0, len(holes), rows_per_chunk):
+                    yield (';' if start else '') + ';'.join(
+                        row_format.format(*hole)
+                        for hole in holes[start:start + rows_per_chunk])
+                yield (']; \n'
+                       'for(i = 1:{}) {{ \n'
+                       '{}'
+                       'addcircle; \n'
+                       'set("radius", r); \n'
+                       'set("x", {}); \n'
+                       'set("y", {}); \n'
+                       'set("z", 0); \n'
+                       'set("z span", zspan); \n'
+                       'set("material", "etch"); \n'
+                       '{}'
+                       '}} \n\n').format(len(holes), enter, x, y, leave)
+
     def generate_matrix(self):
-        matrix = []
-        for line in self:
-            matrix.append(line)
-        matrix = np.flip(np.array(matrix), 0)
-        return matrix
+        # same layout as the grid: matrix[0] is the bottom row. The matrix is
+        # shared by every consumer until the next edit, so it is read-only
+        if self.matrix_version != self.version:
+            self.matrix = self.grid.view('S1').astype('U1')
+            self.matrix.setflags(write=False)
+            self.matrix_version = self.version
+        return self.matrix
+
+    def invalidate(self):
+        # drops the cached matrix, hole table and symmetry without touching
+        # the grid, so the next call generates them again
+        self.matrix_version = -1
+        self.table_key = None
+        self.symmetry_version = -1
 
     def set_size(self):
-        self.x = len(max(self.model.replace(' ', '').splitlines(), key=len))
-        self.y = len(self.model.splitlines())
+        self.version += 1
+        self.y, self.x = self.grid.shape
+        rindex = np.arange(self.y)
+        self.shift = (rindex % 2 == 1) != self.first_null
 
     def set_model(self, model):
-        self.model = model
+        self.grid, self.first_null = self.model_to_grid(model)
+        self.set_size()
 
     def get_model(self):
         return self.model
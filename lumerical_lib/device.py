@@ -0,0 +1,136 @@
+import numpy as np
+
+from lumerical_lib.crystal import HOLE_DTYPE, types, types_key
+from lumerical_lib.spatial import SpatialIndex
+
+# hole table of a device: the crystal records plus the index of their section
+DEVICE_DTYPE = np.dtype(HOLE_DTYPE.descr + [('section', np.intp)])
+
+
+class Device(object):
+    # Crystal sections placed side by side along x. Each section starts at
+    # its offset (the x_init of the crystal), by default right after the
+    # previous one. The holes and ports of every section are merged in one
+    # table sorted by x, so region queries are two binary searches.
+    def __init__(self, sections=()):
+        self.sections = []
+        self.offsets = np.zeros(0)
+        self.table = None
+        self.table_key = None
+        self.spatial = None
+
+        for crystal in sections:
+            self.add(crystal)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def names(self):
+        return [crystal.name for crystal in self.sections]
+
+    def add(self, crystal, x=None):
+        # A section with the name of an existing one replaces it, keeping
+        # its offset unless x is given
+        names = self.names()
+        if crystal.name in names:
+            index = names.index(crystal.name)
+            if x is None:
+                x = self.offsets[index]
+            del self.sections[index]
+            self.offsets = np.delete(self.offsets, index)
+        elif x is None:
+            x = self.bounds()[:, 2].max() if self.sections else 0
+
+        index = np.searchsorted(self.offsets, x, side='right')
+        self.sections.insert(index, crystal)
+        self.offsets = np.insert(self.offsets, index, x)
+        crystal.x_init = x
+
+    def remove(self, name):
+        index = self.names().index(name)
+        del self.sections[index]
+        self.offsets = np.delete(self.offsets, index)
+
+    def bounds(self):
+        # (n, 4) array of xmin, ymin, xmax, ymax of the lattice of each
+        # section, from the first to the last row and column of cells
+        bounds = np.zeros((len(self.sections), 4))
+        for index, crystal in enumerate(self.sections):
+            h = crystal.a*np.sqrt(3)/2
+            bounds[index] = (self.offsets[index], 0,
+                             self.offsets[index] + crystal.x*crystal.a,
+                             crystal.y*h - h)
+        return bounds
+
+    def size(self):
+        if not self.sections:
+            return 0, 0
+        bounds = self.bounds()
+        return bounds[:, 2].max(), bounds[:, 3].max()
+
+    def mirror_plane(self):
+        # y of the plane every section is mirror symmetric about, None if
+        # the sections have no common one
+        planes = [crystal.mirror_plane() for crystal in self.sections]
+        if not planes or None in planes or not np.allclose(planes, planes[0]):
+            return None
+        return planes[0]
+
+    def section_at(self, x):
+        # index of the section holding x (scalar or array), -1 left of the
+        # first one
+        return np.searchsorted(self.offsets, x, side='right') - 1
+
+    def hole_table(self):
+        # Merged hole tables of every section with x in device coordinates,
+        # sorted by x. Rebuilt only when a section is edited or moved, or the
+        # types table changes.
+        key = (tuple((id(crystal), crystal.version, crystal.a)
+                     for crystal in self.sections), self.offsets.tobytes(), types_key())
+        if self.table_key == key:
+            return self.table
+
+        parts = []
+        for index, crystal in enumerate(self.sections):
+            part = np.empty(len(crystal.hole_table()), dtype=DEVICE_DTYPE)
+            for field in HOLE_DTYPE.names:
+                part[field] = crystal.hole_table()[field]
+            part['x'] += self.offsets[index]
+            part['section'] = index
+            parts.append(part)
+
+        table = np.concatenate(parts) if parts else np.empty(0, dtype=DEVICE_DTYPE)
+        table = table[np.argsort(table['x'], kind='stable')]
+        table.setflags(write=False)
+
+        self.table = table
+        self.table_key = key
+        return table
+
+    def index(self):
+        # spatial.SpatialIndex over hole_table(), one lattice constant buckets
+        table = self.hole_table()
+        if self.spatial is None or self.spatial.table is not table:
+            cell = max(crystal.a for crystal in self.sections) if self.sections else None
+            self.spatial = SpatialIndex(table, cell)
+        return self.spatial
+
+    def holes_between(self, xmin, xmax):
+        # records with xmin <= x <= xmax
+        table = self.hole_table()
+        start = np.searchsorted(table['x'], xmin, side='left')
+        stop = np.searchsorted(table['x'], xmax, side='right')
+        return table[start:stop]
+
+    def ports(self, kind):
+        # x and y of the 'source' or 'monitor' cells of every section, in
+        # section then row-major order
+        table = self.hole_table()
+        codes = [ord(simbol) for simbol, type in types.items()
+                 if type['type'] == kind]
+        sites = table[np.isin(table['code'], codes)]
+        sites = sites[np.lexsort((sites['col'], sites['row'], sites['section']))]
+        return sites['x'].copy(), sites['y'].copy()
@@ -1,25 +1,14 @@
+import functools
+import hashlib
 import numpy as np
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
-from scipy import interpolate, constants
-from collections import OrderedDict
-
-import importlib.util
 import os
-import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
 
+from lumerical_lib import analysis
 from lumerical_lib import crystal
-
-os.add_dll_directory('C:\\Program Files\\Lumerical\\v202\\api\\python')
-spec_win = importlib.util.spec_from_file_location(
-    'lumapi', 'C:\\Program Files\\Lumerical\\v202\\api\\python\\lumapi.py')
-spec_lin = importlib.util.spec_from_file_location(
-    'lumapi', "/opt/lumerical/2020a/api/python/lumapi.py")
-spec_mac = importlib.util.spec_from_file_location(
-    'luampi', "/Applications/Lumerical/FDTD Solutions/FDTD Solutions.app/Contents/API/Python/lumapi.py")
-
-lumapi = importlib.util.module_from_spec(spec_win)
-spec_win.loader.exec_module(lumapi)
+from lumerical_lib import device
+from lumerical_lib import solver
 
 types = {
     '0': {'type': 'circle', 'radius': 0.30},
@@ -36,14 +25,36 @@ types = {
 }
 
 
+# type code of a matrix user property in adduserprop
+MATRIX_USERPROP = 6
+
+# material database shipped with the package and the materials it defines
+MATERIAL_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'material.mdf')
+MATERIALS = ('algaas_lpedraza', 'etch')
+
+
+def batched(method):
+    # the solver calls of the method are sent as a single eval
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Fdtd(object):
-    def __init__(self, name="fdtd_file.fsp", new=False):
-        if not new:
-            self.fdtd = lumapi.FDTD(name)
-        else:
-            self.fdtd = lumapi.FDTD()
+    def __init__(self, name="fdtd_file.fsp", new=False, backend=None, cache=None):
+        # backend: a solver.Backend, by default a lumapi session on `name`
+        # (a new project if new=True)
+        # cache: a cache.ScriptCache the structure scripts are taken from
+        if backend is None:
+            backend = solver.LumapiBackend(None if new else name)
+        self.fdtd = backend
+        self.cache = cache
 
         self.structures = {'crystals': {}, 'sources': {}, 'monitors': {}}
+        # the crystals of the session, placed at their x_init
+        self.device = device.Device()
         self.width = 0
         self.height = 0
         self.a = 0.426E-6
@@ -55,9 +66,63 @@ class Fdtd(object):
         self.monitor_index = 0
         self.last_crystal_x = 0
 
-        self.fdtd.importmaterialdb('..\\lumerical_lib\\material.mdf')
+        self.import_materials()
+
+    def import_materials(self, path=MATERIAL_DB):
+        # Each session imports a database (by content) only once, the hashes
+        # are kept on the backend so a pooled session skips it on reuse. A
+        # session that already defines MATERIALS without having imported
+        # anything (an existing project) skips it as well.
+        # -> True if the database was imported
+        with open(path, 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+
+        if self.fdtd.materials is None:
+            self.fdtd.materials = set()
+        if digest in self.fdtd.materials:
+            return False
+        if not self.fdtd.materials and all(
+                self.fdtd.materialexists(name) for name in MATERIALS):
+            self.fdtd.materials.add(digest)
+            return False
+
+        self.fdtd.importmaterialdb(path)
+        self.fdtd.materials.add(digest)
+        return True
+
+    @contextmanager
+    def batch(self):
+        # The calls made on self.fdtd inside the block are queued and sent as
+        # one script when it exits (nothing is sent if the block raises, and
+        # handles kept from it then go straight to the backend). Nested
+        # blocks join the outer batch.
+        if isinstance(self.fdtd, solver.Batch):
+            yield self.fdtd
+            return
+
+        batch = solver.Batch(self.fdtd)
+        self.fdtd = batch
+        try:
+            yield batch
+        except BaseException:
+            batch.discard()
+            raise
+        finally:
+            self.fdtd = batch.backend
+        batch.close()
+
+    def add_crystal(self, crystal: crystal.Crystal, compact=False, putv=False,
+                    incremental=False, symmetry=False):
+        # incremental: the holes are plain named children of the group and
+        # adding the same crystal again only replaces the cells that changed
+        # since the last push, see update_crystal
+        previous = self.structures['crystals'].get(crystal.name, {})
+        fingerprint = crystal.fingerprint() if incremental else None
+        if incremental and previous.get('fingerprint') is not None and \
+                previous['fingerprint']['key'] == fingerprint['key']:
+            self.update_crystal(crystal, fingerprint)
+            return
 
-    def add_crystal(self, crystal: crystal.Crystal):
         self.fdtd.select(crystal.name)
         self.fdtd.delete()
         self.a = crystal.a
@@ -69,98 +134,167 @@ class Fdtd(object):
         pc.y = 0
         pc.z = 0
 
-        crystal.x_init = self.last_crystal_x
+        self.device.add(crystal, self.last_crystal_x)
         self.structures['crystals'][crystal.name] = {
             'f': pc, 'crystal': crystal}
         self.last_crystal_x += crystal.x * crystal.a
-        pc.script = crystal.generate_script()
 
-    def add_sources(self, amp=2.07766e+08, f=1541.3e-9, offset=30E-15, pulselength=50E-15):
-        crystal = self.structures['crystals'][next(
-            iter(self.structures['crystals']))]['crystal']
-        a = crystal.a
-        zspan = crystal.zspan
-        h = a*np.sqrt(3)/2
-        self.source_index = 0
+        if incremental:
+            pc.construction_group = False
+            self.eval_in_group(crystal.name, crystal.iter_cells_script())
+            self.structures['crystals'][crystal.name]['fingerprint'] = fingerprint
+        elif putv:
+            # The circles go through the binary putv channel as an (n, 3)
+            # matrix kept in a user property of the group, so the group
+            # script only walks that matrix. Bends are instanced as in the
+            # compact script.
+            self.fdtd.putv('holes', crystal.circle_table())
+            self.fdtd.eval(
+                f'select("{crystal.name}"); '
+                f'adduserprop("holes", {MATRIX_USERPROP}, holes); clear(holes);')
+            pc.script = self.crystal_script(crystal, compact=True, circles=False) + \
+                crystal.holes_script('holes')
+        else:
+            pc.script = self.crystal_script(crystal, compact=compact, symmetry=symmetry)
+
+    def crystal_script(self, crystal: crystal.Crystal, **options):
+        if self.cache is None:
+            return crystal.generate_script(**options)
+        return self.cache.script(crystal, **options)
+
+    @batched
+    def add_device(self, sections, **kwargs):
+        # Adds every section of a device.Device at its offset, the keyword
+        # arguments go to add_crystal
+        for crystal, x in zip(list(sections), sections.offsets.tolist()):
+            self.last_crystal_x = x
+            self.add_crystal(crystal, **kwargs)
+
+    def update_crystal(self, crystal: crystal.Crystal, fingerprint):
+        entry = self.structures['crystals'][crystal.name]
+        pc = entry['f']
+        old = entry['fingerprint']['cells']
+        new = fingerprint['cells']
+
+        # compare both signatures over the union of their shapes
+        rows = max(old.shape[0], new.shape[0])
+        cols = max(old.shape[1], new.shape[1])
+        old = np.pad(old, ((0, rows - old.shape[0]), (0, cols - old.shape[1])))
+        new = np.pad(new, ((0, rows - new.shape[0]), (0, cols - new.shape[1])))
+        changed = old != new
+
+        script = ''
+        for rindex, cindex in zip(*np.nonzero(changed)):
+            for name in crystal.cell_objects(old[rindex, cindex] // 16, rindex, cindex):
+                script += f'select("{name}"); delete; \n'
+
+        mask = changed[:crystal.y, :crystal.x]
+        self.eval_in_group(crystal.name, [script], crystal.iter_cells_script(mask))
+
+        pc.x = self.last_crystal_x
+        self.device.add(crystal, self.last_crystal_x)
+        entry['crystal'] = crystal
+        entry['fingerprint'] = fingerprint
+        self.last_crystal_x += crystal.x * crystal.a
+        print(f'[log] {crystal.name}: {int(changed.sum())} celulas atualizadas')
 
-        matrix = crystal.generate_matrix()
-
-        for rindex, row in enumerate(matrix):
-            for cindex, simbol in enumerate(row):
-                if simbol not in types.keys():
-                    continue
-                type = types[simbol]
-
-                if type['type'] == 'source':
-                    self.source_index += 1
-                    self.fdtd.select(f'source_{self.source_index}')
-                    self.fdtd.delete()
-
-                    c = constants.c
-
-                    props = OrderedDict([("name", f'source_{self.source_index}'),
-                                         ("amplitude", amp),
-                                         ('injection axis', 'x-axis'),
-                                         ('mode selection', 'fundamental TE mode'),
-                                         ("override global source settings", True),
-                                         # ("wavelength start", 1550e-9),
-                                         # ("wavelength stop", 1550e-9),
-                                         ('set time domain', True),
-                                         ('pulse type', 'standard'),
-                                         ('frequency', (c/f)),  # Hz
-                                         ('offset', offset),  # fs
-                                         ('pulselength', pulselength),  # fs
-                                         ('number of trial modes', 20)
-                                         ])
-                    source = self.fdtd.addmode(properties=props)
-                    source.z_span = 1.14e-6
-                    source.x = cindex*a + a / \
-                        2 if not (rindex %
-                                  2 == 1) == crystal.first_null else (cindex)*a
-                    source.y = rindex*h
-                    source.y_span = 2*a
-
-                    self.structures['sources'][f'source_{self.source_index}'] = {
-                        'f': source}
+    def eval_in_group(self, group, *chunks):
+        script = f'groupscope("::model::{group}"); \n'
+        for part in chunks:
+            script += ''.join(part)
+        script += 'groupscope("::model"); \n'
+        self.fdtd.eval(script)
 
+    @batched
+    def add_sources(self, amp=2.07766e+08, f=1541.3e-9, offset=30E-15, pulselength=50E-15):
+        x, y = self.device.ports('source')
+
+        from scipy import constants
+        c = constants.c
+
+        props = OrderedDict([("amplitude", amp),
+                             ('injection axis', 'x-axis'),
+                             ('mode selection', 'fundamental TE mode'),
+                             ("override global source settings", True),
+                             # ("wavelength start", 1550e-9),
+                             # ("wavelength stop", 1550e-9),
+                             ('set time domain', True),
+                             ('pulse type', 'standard'),
+                             ('frequency', (c/f)),  # Hz
+                             ('offset', offset),  # fs
+                             ('pulselength', pulselength),  # fs
+                             ('number of trial modes', 20),
+                             ('z span', 1.14e-6),
+                             ('y span', 2*self.a)
+                             ])
+        names = self.add_ports('source', 'addmode', x, y, props)
+        self.source_index = len(names)
+        for name in names:
+            self.structures['sources'][name] = {'f': self.fdtd.handle(name)}
+
+    @batched
     def add_monitors(self):
-        crystal = self.structures['crystals'][
-            list(self.structures['crystals'].keys())[-1]
-        ]['crystal']
-        a = crystal.a
+        a = self.a
         h = a*np.sqrt(3)/2
         r = types['1']['radius']*a
-        self.monitor_index = 0
-
-        matrix = crystal.generate_matrix()
-
-        for rindex, row in enumerate(matrix):
-            for cindex, simbol in enumerate(row):
-                if simbol not in types.keys():
-                    continue
-                type = types[simbol]
-
-                if type['type'] == 'monitor':
-                    self.monitor_index += 1
-                    self.fdtd.select(f'monitor_{self.source_index}')
-                    self.fdtd.delete()
-
-                    props = OrderedDict([('name', f'monitor_{self.monitor_index}'),
-                                         ('monitor type', 3),
-                                         ('override global monitor settings', True),
-                                         ('frequency points', 300),
-                                         ('use source limits', True)
-                                         ])
-                    monitor = self.fdtd.addpower(properties=props)
-                    monitor.x = crystal.x_init + cindex*a + a / \
-                        2 if not (rindex %
-                                  2 == 1) == crystal.first_null else (cindex)*a
-                    monitor.y = rindex*h
-                    monitor.y_span = 2*h - 2*r
-
-                    self.structures['monitors'][f'monitor_{self.monitor_index}'] = {
-                        'f': monitor}
-
+        x, y = self.device.ports('monitor')
+
+        # each monitor spans the gap between the holes right below and
+        # above it (2*h - 2*r in a line defect of '1' holes)
+        index = self.device.index()
+        y_span = np.full(len(x), 2*h - 2*r)
+        y_center = y.copy()
+        for i, (px, py) in enumerate(zip(x.tolist(), y.tolist())):
+            bottom, top = index.gap(px, py)
+            bottom = py - h + r if bottom is None else bottom
+            top = py + h - r if top is None else top
+            y_span[i] = top - bottom
+            y_center[i] = (top + bottom)/2
+
+        props = OrderedDict([('monitor type', 3),
+                             ('override global monitor settings', True),
+                             ('frequency points', 300),
+                             ('use source limits', True)
+                             ])
+        names = self.add_ports('monitor', 'addpower', x, y_center, props,
+                               OrderedDict([('y span', y_span)]))
+        self.monitor_index = len(names)
+        for name in names:
+            self.structures['monitors'][name] = {'f': self.fdtd.handle(name)}
+
+    def add_ports(self, prefix, command, x, y, props, columns=None):
+        # Creates prefix_1 ... prefix_n at (x[i], y[i]) with a single script:
+        # the sites go as one matrix and every port gets the same properties.
+        # columns maps properties with one value per port to their arrays,
+        # sent as extra columns of the matrix.
+        # -> names of the ports, in the order of x and y
+        if not len(x):
+            return []
+
+        columns = columns or {}
+        template = ''.join(
+            f'set({solver.script_value(prop)}, {solver.script_value(value)}); \n'
+            for prop, value in props.items())
+        template += ''.join(
+            f'set({solver.script_value(prop)}, {prefix}_at(i, {j})); \n'
+            for j, prop in enumerate(columns, 3))
+        matrix = np.column_stack([x, y] + [columns[prop] for prop in columns])
+        sites = ';'.join(','.join(map(str, row)) for row in matrix.tolist())
+        self.fdtd.eval(
+            f'{prefix}_at = [{sites}]; \n'
+            f'for(i = 1:{len(x)}) {{ \n'
+            f'select("{prefix}_" + num2str(i)); \n'
+            'delete; \n'
+            f'{command}; \n'
+            f'set("name", "{prefix}_" + num2str(i)); \n'
+            + template +
+            f'set("x", {prefix}_at(i, 1)); \n'
+            f'set("y", {prefix}_at(i, 2)); \n'
+            '} \n'
+            f'clear({prefix}_at); \n')
+        return [f'{prefix}_{i}' for i in range(1, len(x) + 1)]
+
+    @batched
     def add_base(self):
         width, height = self.get_size()
 
@@ -180,15 +314,26 @@ class Fdtd(object):
             'f': rect
         }
 
-    def add_analysis(self, movie=False):
+    @batched
+    def add_analysis(self, movie=False, symmetry=None):
+        # symmetry: 'Symmetric' or 'Anti-Symmetric', the y min boundary of
+        # the FDTD region when the device is mirror symmetric about its
+        # center line (the solver then only computes the upper half)
         width, height = self.get_size()
 
         # FDTD
         self.fdtd.select('FDTD')
         self.fdtd.delete()
+        bc = {}
+        if symmetry is not None:
+            plane = self.device.mirror_plane()
+            if plane is not None and np.isclose(plane, height/2, rtol=0, atol=1e-6*self.a):
+                bc = {'y_min_bc': symmetry}
+            else:
+                print('[log] Dispositivo sem simetria no centro, mantendo PML')
         fdtd = self.fdtd.addfdtd(dimension="2D", x=width/2, y=height/2,
                                  x_span=width + 2*self.x_margin,
-                                 y_span=height + 2*self.y_margin)
+                                 y_span=height + 2*self.y_margin, **bc)
         self.structures['fdtd'] = {'f': fdtd}
 
         # Field Monitor
@@ -220,11 +365,52 @@ class Fdtd(object):
             self.fdtd.set('scale', 2e16)
             self.structures['movie'] = {'f': movie}
 
-    def get_size(self):
-        crystal = self.structures['crystals'][next(
-            iter(self.structures['crystals']))]['crystal']
+    @batched
+    def add_band_structure(self, crystal: crystal.Crystal, kx=0.0, f_min=150e12,
+                           f_max=250e12, dipoles=5, monitors=5,
+                           sim_time=2000e-15, seed=0):
+        # Replaces the FDTD region by one supercell in the middle of the
+        # crystal (already added) with Bloch boundaries along x, kx in units
+        # of 2*pi/x span. Magnetic dipoles excite the modes and time monitors
+        # record them, both at random points of the dielectric.
+        period = analysis.find_supercell(crystal)
+        if period is None:
+            raise ValueError(f'{crystal.name}: cristal nao e periodico em x')
 
-        h = self.a * np.sqrt(3)/2
-        height = crystal.y * h - h
-        width = self.last_crystal_x
-        return width, height
+        a = crystal.a
+        h = a*np.sqrt(3)/2
+        height = crystal.y*h - h
+        xmin = (crystal.x//2//period)*period*a
+        xmax = xmin + period*a
+
+        self.fdtd.select('FDTD')
+        self.fdtd.delete()
+        fdtd = self.fdtd.addfdtd(dimension="2D", x=crystal.x_init + (xmin + xmax)/2,
+                                 y=height/2, x_span=xmax - xmin,
+                                 y_span=height + 2*self.y_margin,
+                                 x_min_bc='Bloch', x_max_bc='Bloch',
+                                 bloch_units='bandstructure', kx=kx,
+                                 simulation_time=sim_time)
+
+        sites = analysis.free_sites(crystal, xmin, xmax, dipoles + monitors, seed)
+        x = crystal.x_init + sites[:, 0]
+        y = sites[:, 1]
+        props = OrderedDict([('dipole type', 'Magnetic dipole'),
+                             ('override global source settings', True),
+                             ('frequency start', f_min),
+                             ('frequency stop', f_max)
+                             ])
+        sources = self.add_ports('dipole', 'adddipole', x[:dipoles], y[:dipoles], props)
+        probes = self.add_ports('time', 'addtime', x[dipoles:], y[dipoles:],
+                                OrderedDict())
+
+        self.structures['fdtd'] = {'f': fdtd}
+        self.structures['band'] = {
+            'crystal': crystal, 'period': period, 'kx': kx,
+            'dipoles': [self.fdtd.handle(name) for name in sources],
+            'monitors': [self.fdtd.handle(name) for name in probes]}
+        return period
+
+    def get_size(self):
+        # extents of all the sections, the tallest one sets the height
+        return self.device.size()
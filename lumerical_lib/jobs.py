@@ -0,0 +1,339 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from lumerical_lib import crystal as crystal_module
+from lumerical_lib import pool
+from lumerical_lib import solver
+from lumerical_lib import sweep as sweep_module
+
+# Sweeps as jobs on disk, so they can be spread over nodes sharing a
+# directory and resumed after a crash. Every point of the sweep (see
+# sweep.grid) gets a directory <workdir>/<name>_<index> with
+#   project.fsp    - the built project
+#   manifest.json  - point, geometry key, state and the requested results
+#   results.pkl    - {(monitor, result): value} once the job is done
+#   lock           - only while a node runs the job
+# state goes built -> done or failed. Running a sweep again on the same
+# workdir builds only the missing points (or those whose geometry key
+# changed) and runs only the jobs that are not done.
+
+MANIFEST = 'manifest.json'
+PROJECT = 'project.fsp'
+RESULTS = 'results.pkl'
+LOCK = 'lock'
+
+
+def read_manifest(job):
+    try:
+        with open(os.path.join(job, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(job, manifest):
+    # written under a temporary name first, as in cache.ScriptCache.put
+    path = os.path.join(job, MANIFEST)
+    tmp = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp, path)
+
+
+def read_results(job):
+    with open(os.path.join(job, RESULTS), 'rb') as file:
+        return pickle.load(file)
+
+
+def built(job):
+    return os.path.exists(os.path.join(job, PROJECT))
+
+
+def plain(point):
+    # the point with numpy values (np.arange axes, float32 ...) turned into
+    # python ones, as json stores and reads it back
+    return {key: np.asarray(value).tolist() for key, value in point.items()}
+
+
+def geometry_key(crystal):
+    # everything besides the point that shapes the built project, as in
+    # cache.ScriptCache.key
+    parts = (crystal.model, crystal.a, crystal.zspan, crystal.border,
+             crystal_module.types_key(), crystal_module.SCRIPT_VERSION)
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def build(crystal, points, workdir, results=(('monitor_1', 'T'),),
+          factory=solver.LumapiBackend):
+    # builds the points without a project in workdir (or whose point or
+    # geometry key changed), -> the job directories in the order of the
+    # points. A job whose requested results changed is run again.
+    base = {'a': crystal.a, 'zspan': crystal.zspan}
+    key = geometry_key(crystal)
+    results = [list(pair) for pair in results]
+    jobs = []
+    with pool.SessionPool(1, factory) as builders:
+        for index, point in enumerate(points):
+            job = os.path.join(workdir, f'{crystal.name}_{index}')
+            jobs.append(job)
+            manifest = read_manifest(job)
+            if manifest is not None and built(job) and manifest.get('key') == key and \
+                    manifest['point'] == plain(point):
+                if manifest['results'] != results:
+                    manifest.update(state='built', results=results, error=None)
+                    write_manifest(job, manifest)
+                continue
+
+            os.makedirs(job, exist_ok=True)
+            manifest = {'index': index, 'point': plain(point), 'key': key, 'state': 'built',
+                        'results': results, 'host': None, 'error': None, 'time': None}
+            params = dict(base, **point)
+            previous = {}
+            try:
+                previous = sweep_module.set_radii(sweep_module.radii_of(params))
+                with builders.session() as f:
+                    sweep_module.build_point(f, f'{crystal.name}_{index}', crystal.model,
+                                             params, os.path.join(job, PROJECT))
+            except Exception as err:
+                # left without a project, built again on the next run
+                if built(job):
+                    os.remove(os.path.join(job, PROJECT))
+                manifest['state'] = 'failed'
+                manifest['error'] = str(err)
+                print(f'[log] Job {job} nao foi montado: {err}')
+            finally:
+                sweep_module.set_radii(previous)
+            write_manifest(job, manifest)
+    return jobs
+
+
+def run_job(job, backend):
+    # loads and runs the project of a job, recording the outcome in its
+    # manifest; -> the new state
+    manifest = read_manifest(job)
+    manifest['host'] = socket.gethostname()
+    start = time.time()
+    try:
+        backend.load(os.path.join(job, PROJECT))
+        backend.run()
+        output = sweep_module.read_results(backend, manifest['results'])
+        with open(os.path.join(job, RESULTS), 'wb') as file:
+            pickle.dump(output, file)
+    except Exception as err:
+        manifest['state'] = 'failed'
+        manifest['error'] = str(err)
+        print(f'[log] Job {job} falhou: {err}')
+    else:
+        manifest['state'] = 'done'
+        manifest['error'] = None
+    manifest['time'] = time.time() - start
+    write_manifest(job, manifest)
+    return manifest['state']
+
+
+class Executor(object):
+    # Runs the given job directories; returns once every one of them is done
+    # or failed
+    def run(self, jobs):
+        raise NotImplementedError
+
+
+def run_pooled(job):
+    # job of a LocalExecutor, on the session of the worker process
+    backend = sweep_module.session_pool.acquire()
+    state = run_job(job, backend)
+    sweep_module.session_pool.release(backend, broken=not backend.ping())
+    return state
+
+
+class LocalExecutor(Executor):
+    # jobs spread over processes of this machine, each with a warm session
+    def __init__(self, workers=None, factory=solver.LumapiBackend):
+        self.workers = workers or os.cpu_count()
+        self.factory = factory
+
+    def run(self, jobs):
+        if not jobs:
+            return
+        workers = max(1, min(self.workers, len(jobs)))
+        with multiprocessing.Pool(workers, initializer=sweep_module.start_worker,
+                                  initargs=(self.factory,)) as processes:
+            processes.map(run_pooled, jobs, chunksize=1)
+
+
+def lock_owner(path):
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def claim(job, stale):
+    # Takes the lock of a job, -> the token written in it or None. O_EXCL
+    # makes the creation atomic on a shared directory. A lock not refreshed
+    # for stale seconds belongs to a node that died: it is renamed to a
+    # name of our own first, so only one node takes it over, and put back
+    # if it turns out to be fresh (replaced in the meantime).
+    path = os.path.join(job, LOCK)
+    token = f'{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}'
+    try:
+        if time.time() - os.path.getmtime(path) > stale:
+            moved = f'{path}.{uuid.uuid4().hex}.stale'
+            os.rename(path, moved)
+            if time.time() - os.path.getmtime(moved) > stale:
+                os.remove(moved)
+            else:
+                try:
+                    os.link(moved, path)
+                except FileExistsError:
+                    pass
+                os.remove(moved)
+                return None
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, 'w') as file:
+        file.write(f'{token}\n')
+    return token
+
+
+def unlock(job, token):
+    # removes the lock only while it is still ours
+    path = os.path.join(job, LOCK)
+    if lock_owner(path) == token:
+        os.remove(path)
+
+
+def heartbeat(job, token, stop, interval):
+    path = os.path.join(job, LOCK)
+    while not stop.wait(interval):
+        if lock_owner(path) == token:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+
+def pending(jobs):
+    # built jobs that are not done
+    return [job for job in jobs if built(job) and
+            (read_manifest(job) or {}).get('state') not in ('done', None)]
+
+
+def worker(workdir, factory=solver.LumapiBackend, interval=30, stale=120, once=True):
+    # Runs the jobs of a shared workdir on this node, one at a time, until
+    # none is left (or forever, polling every interval seconds, with
+    # once=False). Started on every node of the sweep.
+    with pool.SessionPool(1, factory) as sessions:
+        while True:
+            jobs = sorted(os.path.join(workdir, name) for name in os.listdir(workdir))
+            ran = False
+            for job in pending([job for job in jobs if os.path.isdir(job)]):
+                if read_manifest(job)['state'] != 'built':
+                    continue
+                # the session first, a node that can not get one claims nothing
+                backend = sessions.acquire()
+                token = None
+                try:
+                    token = claim(job, stale)
+                    if token is None or read_manifest(job)['state'] != 'built':
+                        # taken or finished by another node in the meantime
+                        continue
+                    stop = threading.Event()
+                    threading.Thread(target=heartbeat, args=(job, token, stop, interval),
+                                     daemon=True).start()
+                    try:
+                        run_job(job, backend)
+                    finally:
+                        stop.set()
+                    ran = True
+                finally:
+                    if token is not None:
+                        unlock(job, token)
+                    sessions.release(backend, broken=not backend.ping())
+            if once and not ran:
+                return
+            if not ran:
+                time.sleep(interval)
+
+
+class SharedQueueExecutor(Executor):
+    # Jobs left in a directory shared by the nodes, each running
+    #   python -m lumerical_lib.jobs <workdir>
+    # run() only waits for them (and runs jobs itself with local=True).
+    # Jobs that failed are put back in the queue.
+    def __init__(self, local=False, factory=solver.LumapiBackend, interval=30, stale=120):
+        self.local = local
+        self.factory = factory
+        self.interval = interval
+        self.stale = stale
+
+    def run(self, jobs):
+        for job in pending(jobs):
+            manifest = read_manifest(job)
+            if manifest['state'] == 'failed':
+                manifest['state'] = 'built'
+                write_manifest(job, manifest)
+        workdirs = sorted(set(os.path.dirname(job) for job in jobs))
+        while True:
+            if self.local:
+                for workdir in workdirs:
+                    worker(workdir, self.factory, self.interval, self.stale)
+            left = [job for job in pending(jobs) if read_manifest(job)['state'] == 'built']
+            if not left:
+                return
+            time.sleep(self.interval)
+
+
+def run(crystal, points, workdir, executor=None, results=(('monitor_1', 'T'),),
+        factory=solver.LumapiBackend):
+    # sweep.sweep through jobs on disk: builds what is missing, runs what is
+    # not done (failed jobs are tried again) and collects every result
+    jobs = build(crystal, points, workdir, results, factory)
+    executor = executor or LocalExecutor(factory=factory)
+    todo = pending(jobs)
+    done = [job for job in jobs if read_manifest(job)['state'] == 'done']
+    print(f'[log] {len(done)} de {len(jobs)} jobs ja concluidos')
+    unbuilt = [job for job in jobs if not built(job)]
+    if unbuilt:
+        print(f'[log] {len(unbuilt)} jobs nao foram montados e nao serao executados')
+    executor.run(todo)
+    return collect(points, jobs)
+
+
+def collect(points, jobs):
+    dataset = sweep_module.Dataset(points, sweep_module.axes_of(points))
+    for index, job in enumerate(jobs):
+        manifest = read_manifest(job)
+        if manifest['state'] == 'done':
+            dataset.files[index] = os.path.join(job, PROJECT)
+            dataset.results[index] = read_results(job)
+        else:
+            dataset.errors[index] = manifest['error'] or manifest['state']
+    return dataset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Executa os jobs de uma varredura em um diretorio compartilhado')
+    parser.add_argument('workdir')
+    parser.add_argument('--interval', type=float, default=30)
+    parser.add_argument('--stale', type=float, default=120)
+    parser.add_argument('--forever', action='store_true',
+                        help='continua esperando novos jobs')
+    args = parser.parse_args()
+    worker(args.workdir, interval=args.interval, stale=args.stale, once=not args.forever)
@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import time
+
+from lumerical_lib import pool
+from lumerical_lib import solver
+from lumerical_lib import sweep as sweep_module
+
+# Build-then-run pipelining of a sweep (see sweep.grid for the points). One
+# producer thread builds and saves the project of each point in its own
+# session while solver threads load the saved files and run them, so layout
+# of the next points overlaps the solver. The producer stops ahead of the
+# solvers when `depth` files are waiting or the files not yet solved take
+# more than max_bytes of disk, whichever comes first.
+#
+# Only the producer patches the types radii, the solver threads just load
+# and run files, so threads are enough here.
+
+
+class Pipeline(object):
+    def __init__(self, crystal, points, results=(('monitor_1', 'T'),),
+                 workdir='.', solvers=1, depth=2, max_bytes=2**30, keep=True,
+                 factory=solver.LumapiBackend):
+        self.crystal = crystal
+        self.points = points
+        self.results = list(results)
+        self.workdir = workdir
+        self.solvers = solvers
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.factory = factory
+
+        self.queue = queue.Queue(depth)
+        self.pending = 0  # bytes of the files saved and not yet solved
+        self.condition = threading.Condition()
+        self.dataset = sweep_module.Dataset(points, sweep_module.axes_of(points))
+        self.build_time = 0.0
+        self.solve_time = 0.0
+
+    def reserve(self):
+        # waits for room on disk, an empty pipeline always has room
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.pending == 0 or self.pending < self.max_bytes)
+
+    def add_pending(self, size):
+        with self.condition:
+            self.pending += size
+            self.condition.notify_all()
+
+    def build(self, builders, index, point):
+        name = self.crystal.name
+        path = os.path.join(self.workdir, f'{name}_{index}.fsp')
+        params = dict({'a': self.crystal.a, 'zspan': self.crystal.zspan}, **point)
+        previous = {}
+        try:
+            previous = sweep_module.set_radii(sweep_module.radii_of(params))
+            with builders.session() as f:
+                sweep_module.build_point(f, f'{name}_{index}', self.crystal.model,
+                                         params, path)
+        finally:
+            sweep_module.set_radii(previous)
+        return path
+
+    def produce(self):
+        try:
+            with pool.SessionPool(1, self.factory) as builders:
+                for index, point in enumerate(self.points):
+                    self.reserve()
+                    start = time.perf_counter()
+                    try:
+                        path = self.build(builders, index, point)
+                    except Exception as err:
+                        self.fail(index, err)
+                        continue
+                    finally:
+                        self.build_time += time.perf_counter() - start
+
+                    size = os.path.getsize(path) if os.path.exists(path) else 0
+                    self.add_pending(size)
+                    self.queue.put((index, path, size))
+        finally:
+            for __solver in range(self.solvers):
+                self.queue.put(None)
+
+    def solve(self, sessions):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            index, path, size = job
+            start = time.perf_counter()
+            # a failure of the session itself is a failure of the point, the
+            # thread keeps reading the queue so the producer never blocks
+            backend = None
+            broken = False
+            try:
+                backend = sessions.acquire()
+                backend.load(path)
+                backend.run()
+                output = sweep_module.read_results(backend, self.results)
+            except Exception as err:
+                broken = backend is not None and not backend.ping()
+                self.fail(index, err)
+            else:
+                self.dataset.files[index] = path
+                self.dataset.results[index] = output
+            finally:
+                if backend is not None:
+                    sessions.release(backend, broken)
+                if not self.keep and os.path.exists(path):
+                    os.remove(path)
+                    self.dataset.files[index] = None
+                self.add_pending(-size)
+                with self.condition:
+                    self.solve_time += time.perf_counter() - start
+
+    def fail(self, index, err):
+        self.dataset.errors[index] = err
+        print(f'[log] Ponto {index} da varredura falhou: {err}')
+
+    def run(self):
+        os.makedirs(self.workdir, exist_ok=True)
+        start = time.perf_counter()
+        with pool.SessionPool(self.solvers, self.factory) as sessions:
+            threads = [threading.Thread(target=self.produce, daemon=True)]
+            threads += [threading.Thread(target=self.solve, args=(sessions,), daemon=True)
+                        for __solver in range(self.solvers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        print(f'[log] {len(self.points)} pontos em {time.perf_counter() - start:.1f} s '
+              f'(montagem {self.build_time:.1f} s, solver {self.solve_time:.1f} s)')
+        return self.dataset
+
+
+def pipeline(crystal, points, **kwargs):
+    # sweep.sweep with the building of the next points overlapped with the
+    # solver, kwargs go to Pipeline
+    return Pipeline(crystal, points, **kwargs).run()
@@ -0,0 +1,106 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from lumerical_lib import fdtd
+from lumerical_lib import solver
+
+
+class SessionPool(object):
+    # Keeps up to `size` solver sessions alive between jobs. A session is
+    # handed out already reset to an empty layout (switchtolayout +
+    # deleteall); one that fails its health check is closed and replaced.
+    # Sessions left idle for more than idle_timeout seconds are closed the
+    # next time the pool is used.
+    def __init__(self, size=1, factory=None, idle_timeout=600):
+        self.size = size
+        self.factory = factory or solver.LumapiBackend
+        self.idle_timeout = idle_timeout
+        self.idle = []  # (backend, released at)
+        self.busy = 0
+        self.started = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.idle) + self.busy
+
+    def acquire(self, timeout=None):
+        with self.condition:
+            self.evict()
+            if not self.condition.wait_for(
+                    lambda: self.idle or self.busy < self.size, timeout):
+                raise TimeoutError('Nenhuma sessao livre no pool')
+            backend = self.idle.pop()[0] if self.idle else None
+            self.busy += 1
+
+        try:
+            if backend is not None and not self.reset(backend):
+                self.discard(backend)
+                backend = None
+            if backend is None:
+                backend = self.factory()
+                self.started += 1
+        except BaseException:
+            with self.condition:
+                self.busy -= 1
+                self.condition.notify()
+            raise
+        return backend
+
+    def release(self, backend, broken=False):
+        with self.condition:
+            self.busy -= 1
+            if not broken:
+                self.idle.append((backend, time.monotonic()))
+            self.condition.notify()
+        if broken:
+            self.discard(backend)
+
+    def reset(self, backend):
+        try:
+            backend.switchtolayout()
+            backend.deleteall()
+        except Exception:
+            return False
+        return backend.ping()
+
+    def discard(self, backend):
+        try:
+            backend.close()
+        except Exception:
+            pass
+
+    def evict(self):
+        # called with the condition held
+        now = time.monotonic()
+        expired = [backend for backend, released in self.idle
+                   if now - released > self.idle_timeout]
+        self.idle = [(backend, released) for backend, released in self.idle
+                     if now - released <= self.idle_timeout]
+        for backend in expired:
+            self.discard(backend)
+
+    @contextmanager
+    def session(self, timeout=None, **kwargs):
+        # Fdtd on a pooled session, kwargs go to Fdtd. The session goes back
+        # to the pool on exit, unless the block raised and it stopped
+        # answering
+        backend = self.acquire(timeout)
+        try:
+            yield fdtd.Fdtd(backend=backend, **kwargs)
+        except BaseException:
+            self.release(backend, broken=not backend.ping())
+            raise
+        self.release(backend)
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for backend, __released in idle:
+            self.discard(backend)
@@ -0,0 +1,691 @@
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+
+# Where lumapi.py lives, by sys.platform prefix. The LUMAPI_PATH environment
+# variable (a lumapi.py file or the directory holding it) takes precedence,
+# set_lumapi_path() changes the entry of a platform at runtime.
+LUMAPI_PATHS = {
+    'win32': 'C:\\Program Files\\Lumerical\\v202\\api\\python\\lumapi.py',
+    'linux': '/opt/lumerical/2020a/api/python/lumapi.py',
+    'darwin': '/Applications/Lumerical/FDTD Solutions/FDTD Solutions.app/Contents/API/Python/lumapi.py',
+}
+
+lumapi = None
+
+
+def set_lumapi_path(path, platform=None):
+    LUMAPI_PATHS[platform or sys.platform] = path
+
+
+def lumapi_path():
+    path = os.environ.get('LUMAPI_PATH')
+    if path is None:
+        for platform, default in LUMAPI_PATHS.items():
+            if sys.platform.startswith(platform):
+                path = default
+                break
+    if path is None:
+        raise RuntimeError(
+            f'Caminho do lumapi desconhecido para {sys.platform}, '
+            'defina LUMAPI_PATH ou use set_lumapi_path()')
+
+    if os.path.isdir(path):
+        path = os.path.join(path, 'lumapi.py')
+    return path
+
+
+def load_lumapi():
+    # lumapi is only imported the first time a solver session is needed, so
+    # the geometry code runs on machines without Lumerical
+    global lumapi
+    if lumapi is None:
+        path = lumapi_path()
+        if hasattr(os, 'add_dll_directory'):
+            os.add_dll_directory(os.path.dirname(path))
+
+        spec = importlib.util.spec_from_file_location('lumapi', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        lumapi = module
+    return lumapi
+
+
+class Handle(object):
+    # Object of a backend known only by name (created from a script), each
+    # assignment is a select + set and each read a select + get
+    def __init__(self, backend, name):
+        object.__setattr__(self, 'backend', backend)
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, attr, value):
+        self.backend.select(self.name)
+        self.backend.set(attr.replace('_', ' '), value)
+        if attr == 'name':
+            object.__setattr__(self, 'name', value)
+
+    def __getattr__(self, attr):
+        self.backend.select(self.name)
+        return self.backend.get(attr.replace('_', ' '))
+
+
+class Backend(object):
+    # The solver calls made by Fdtd. A backend wraps one solver session,
+    # objects returned by the add* calls take property assignments
+    # (obj.x = 1e-6) like the lumapi SimObject does.
+
+    # hashes of the material databases imported in the session, kept by
+    # Fdtd.import_materials
+    materials = None
+
+    def handle(self, name):
+        return Handle(self, name)
+
+    def select(self, name):
+        raise NotImplementedError
+
+    def delete(self):
+        raise NotImplementedError
+
+    def set(self, prop, value):
+        raise NotImplementedError
+
+    def addstructuregroup(self, **kwargs):
+        raise NotImplementedError
+
+    def addmode(self, **kwargs):
+        raise NotImplementedError
+
+    def addpower(self, **kwargs):
+        raise NotImplementedError
+
+    def addrect(self, **kwargs):
+        raise NotImplementedError
+
+    def addfdtd(self, **kwargs):
+        raise NotImplementedError
+
+    def addprofile(self, **kwargs):
+        raise NotImplementedError
+
+    def addindex(self, **kwargs):
+        raise NotImplementedError
+
+    def addmovie(self, **kwargs):
+        raise NotImplementedError
+
+    def adddipole(self, **kwargs):
+        raise NotImplementedError
+
+    def addtime(self, **kwargs):
+        raise NotImplementedError
+
+    def importmaterialdb(self, path):
+        raise NotImplementedError
+
+    def materialexists(self, name):
+        raise NotImplementedError
+
+    def eval(self, script):
+        raise NotImplementedError
+
+    def putv(self, name, value):
+        raise NotImplementedError
+
+    def getv(self, name):
+        raise NotImplementedError
+
+    def get(self, prop):
+        raise NotImplementedError
+
+    def save(self, path=None):
+        raise NotImplementedError
+
+    def load(self, path):
+        raise NotImplementedError
+
+    def run(self):
+        raise NotImplementedError
+
+    def getresult(self, name, result):
+        raise NotImplementedError
+
+    def switchtolayout(self):
+        raise NotImplementedError
+
+    def deleteall(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def ping(self):
+        # a full round trip through the session, False if it is gone
+        try:
+            self.putv('_ping', 1.0)
+            return float(self.getv('_ping')) == 1.0
+        except Exception:
+            return False
+
+
+class LumapiBackend(Backend):
+    # A real session through lumapi. Anything outside the Backend interface
+    # (getresult, switchtolayout, ...) is forwarded to the session as well.
+    def __init__(self, name=None):
+        lumapi = load_lumapi()
+        if name is None:
+            self.session = lumapi.FDTD()
+        else:
+            self.session = lumapi.FDTD(name)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def select(self, name):
+        return self.session.select(name)
+
+    def delete(self):
+        return self.session.delete()
+
+    def set(self, prop, value):
+        return self.session.set(prop, value)
+
+    def addstructuregroup(self, **kwargs):
+        return self.session.addstructuregroup(**kwargs)
+
+    def addmode(self, **kwargs):
+        return self.session.addmode(**kwargs)
+
+    def addpower(self, **kwargs):
+        return self.session.addpower(**kwargs)
+
+    def addrect(self, **kwargs):
+        return self.session.addrect(**kwargs)
+
+    def addfdtd(self, **kwargs):
+        return self.session.addfdtd(**kwargs)
+
+    def addprofile(self, **kwargs):
+        return self.session.addprofile(**kwargs)
+
+    def addindex(self, **kwargs):
+        return self.session.addindex(**kwargs)
+
+    def addmovie(self, **kwargs):
+        return self.session.addmovie(**kwargs)
+
+    def adddipole(self, **kwargs):
+        return self.session.adddipole(**kwargs)
+
+    def addtime(self, **kwargs):
+        return self.session.addtime(**kwargs)
+
+    def importmaterialdb(self, path):
+        return self.session.importmaterialdb(path)
+
+    def materialexists(self, name):
+        return bool(self.session.materialexists(name))
+
+    def eval(self, script):
+        return self.session.eval(script)
+
+    def putv(self, name, value):
+        return self.session.putv(name, value)
+
+    def getv(self, name):
+        return self.session.getv(name)
+
+    def get(self, prop):
+        return self.session.get(prop)
+
+    def save(self, path=None):
+        if path is None:
+            return self.session.save()
+        return self.session.save(path)
+
+    def load(self, path):
+        return self.session.load(path)
+
+    def run(self):
+        return self.session.run()
+
+    def getresult(self, name, result):
+        return self.session.getresult(name, result)
+
+    def switchtolayout(self):
+        return self.session.switchtolayout()
+
+    def deleteall(self):
+        return self.session.deleteall()
+
+    def close(self):
+        return self.session.close()
+
+
+# names Lumerical gives to new objects
+DEFAULT_NAMES = {
+    'addstructuregroup': 'structure group',
+    'addmode': 'source',
+    'addpower': 'DFT',
+    'addrect': 'rectangle',
+    'addfdtd': 'FDTD',
+    'addprofile': 'monitor',
+    'addindex': 'index',
+    'addmovie': 'movie',
+    'adddipole': 'dipole',
+    'addtime': 'time',
+}
+
+
+class RecordedObject(object):
+    # stands for a SimObject of a RecordingBackend
+    def __init__(self, backend, name):
+        object.__setattr__(self, 'backend', backend)
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, attr, value):
+        prop = attr.replace('_', ' ')
+        self.backend.call('set', self.name, prop, value)
+        self.backend.set_property(self.name, prop, value)
+        if prop == 'name':
+            object.__setattr__(self, 'name', value)
+
+    def __getattr__(self, attr):
+        self.backend.call('get', self.name, attr.replace('_', ' '))
+        return self.backend.objects[self.name].get(attr.replace('_', ' '))
+
+
+class RecordingBackend(Backend):
+    # In-memory stand-in for a solver session. Every call, including the
+    # property assignments on returned objects, counts as one round trip
+    # and waits `latency` seconds, so session building can be timed and
+    # inspected without Lumerical. The layout is kept as a dict of objects.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.round_trips = 0
+        self.objects = {}
+        self.selected = []
+        self.variables = {}
+        self.saved = []
+        self.runs = 0
+        self.closed = False
+        self.databases = []
+        self.results = {}
+        self.loaded = None
+
+    def call(self, method, *args, **kwargs):
+        if self.closed:
+            raise RuntimeError('Sessao encerrada')
+        self.round_trips += 1
+        self.calls.append((method, args, kwargs))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def counts(self):
+        counts = {}
+        for method, __args, __kwargs in self.calls:
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+    def set_property(self, name, prop, value):
+        props = self.objects.pop(name)
+        props[prop] = value
+        self.objects[props['name']] = props
+
+    def add(self, kind, kwargs):
+        self.call(kind, **kwargs)
+        props = {'kind': kind}
+        props.update(kwargs.pop('properties', {}))
+        props.update({key.replace('_', ' '): value for key, value in kwargs.items()})
+        name = props.setdefault('name', DEFAULT_NAMES[kind])
+        self.objects[name] = props
+        self.selected = [name]
+        return RecordedObject(self, name)
+
+    def select(self, name):
+        self.call('select', name)
+        self.selected = [name] if name in self.objects else []
+
+    def delete(self):
+        self.call('delete')
+        for name in self.selected:
+            del self.objects[name]
+        self.selected = []
+
+    def set(self, prop, value):
+        self.call('set', prop, value)
+        for name in list(self.selected):
+            self.set_property(name, prop, value)
+
+    def addstructuregroup(self, **kwargs):
+        return self.add('addstructuregroup', kwargs)
+
+    def addmode(self, **kwargs):
+        return self.add('addmode', kwargs)
+
+    def addpower(self, **kwargs):
+        return self.add('addpower', kwargs)
+
+    def addrect(self, **kwargs):
+        return self.add('addrect', kwargs)
+
+    def addfdtd(self, **kwargs):
+        return self.add('addfdtd', kwargs)
+
+    def addprofile(self, **kwargs):
+        return self.add('addprofile', kwargs)
+
+    def addindex(self, **kwargs):
+        return self.add('addindex', kwargs)
+
+    def addmovie(self, **kwargs):
+        return self.add('addmovie', kwargs)
+
+    def adddipole(self, **kwargs):
+        return self.add('adddipole', kwargs)
+
+    def addtime(self, **kwargs):
+        return self.add('addtime', kwargs)
+
+    def importmaterialdb(self, path):
+        self.call('importmaterialdb', path)
+        self.databases.append(path)
+
+    def materialexists(self, name):
+        # every material is taken as defined once a database was imported
+        self.call('materialexists', name)
+        return bool(self.databases)
+
+    def eval(self, script):
+        self.call('eval', script)
+
+    def putv(self, name, value):
+        self.call('putv', name, value)
+        self.variables[name] = value
+
+    def getv(self, name):
+        self.call('getv', name)
+        return self.variables[name]
+
+    def get(self, prop):
+        self.call('get', prop)
+        return self.objects[self.selected[0]].get(prop)
+
+    def save(self, path=None):
+        self.call('save', path)
+        self.saved.append(path)
+
+    def load(self, path):
+        # the layout of a saved project is not known here, it starts empty
+        self.call('load', path)
+        self.loaded = path
+        self.objects = {}
+        self.selected = []
+
+    def run(self):
+        self.call('run')
+        self.runs += 1
+
+    def getresult(self, name, result):
+        # nothing is simulated, results are whatever was stored in
+        # self.results[(name, result)]
+        self.call('getresult', name, result)
+        return self.results.get((name, result))
+
+    def switchtolayout(self):
+        self.call('switchtolayout')
+
+    def deleteall(self):
+        self.call('deleteall')
+        self.objects = {}
+        self.selected = []
+
+    def close(self):
+        self.call('close')
+        self.closed = True
+
+
+class BatchError(RuntimeError):
+    # a queued call of a Batch failed when the script ran in the solver
+    def __init__(self, message, op=None, call=None, site=None):
+        super().__init__(message)
+        self.op = op
+        self.call = call
+        self.site = site
+
+
+def script_value(value):
+    # python value -> Lumerical script literal
+    if isinstance(value, (bool, np.bool_)):
+        return '1' if value else '0'
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, str):
+        return script_string(value)
+    raise TypeError(f'Valor sem representacao em script: {value!r}')
+
+
+def script_string(text):
+    # Lumerical strings have no escapes: lines are joined with endl and a
+    # line holding both quote kinds is split around its double quotes
+    lines = []
+    for line in text.split('\n'):
+        if "'" not in line:
+            lines.append(f"'{line}'")
+        elif '"' not in line:
+            lines.append(f'"{line}"')
+        else:
+            lines.append(' + \'"\' + '.join(f'"{part}"' for part in line.split('"')))
+    return ' + endl + '.join(lines)
+
+
+class BatchObject(object):
+    # Handle of an object created inside a Batch. Until the batch is sent,
+    # assignments are queued; afterwards they go to the backend through
+    # select + set, and reads through select + get.
+    def __init__(self, batch, name):
+        object.__setattr__(self, 'batch', batch)
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, attr, value):
+        prop = attr.replace('_', ' ')
+        self.batch.set_on(self, prop, value)
+        if prop == 'name':
+            object.__setattr__(self, 'name', value)
+
+    def __getattr__(self, attr):
+        return self.batch.get_on(self, attr.replace('_', ' '))
+
+
+class Batch(Backend):
+    # Queues the calls made on a backend as one Lumerical script and sends it
+    # with a single eval on flush(). Before each queued call the script sets
+    # _batch_op to its index, so a failure is traced back to the python line
+    # that made the call. Calls that return something or change the session
+    # (putv, getv, getresult, materialexists, importmaterialdb, save, load,
+    # run, switchtolayout, deleteall) can not be queued: they flush what is
+    # pending and go straight to the backend. close() ends the batch, not the
+    # session.
+    def __init__(self, backend):
+        self.backend = backend
+        self.script = []
+        self.ops = []
+        self.current = None
+        self.open = True
+
+    def __len__(self):
+        return len(self.ops)
+
+    def handle(self, name):
+        return BatchObject(self, name)
+
+    def record(self, method, line, *args):
+        if not self.open:
+            raise RuntimeError('Lote ja enviado')
+        # first frame outside this module: the call that queued the line
+        frame = sys._getframe(1)
+        while frame.f_code.co_filename == __file__:
+            frame = frame.f_back
+        site = (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+        self.ops.append(((method,) + args, site))
+        self.script.append(f'_batch_op = {len(self.ops)}; {line}\n')
+
+    def flush(self):
+        script = ''.join(self.script)
+        self.script = []
+        self.current = None
+        if not script:
+            return
+        try:
+            self.backend.eval(script)
+        except Exception as err:
+            self.fail(err)
+
+    def fail(self, err):
+        try:
+            op = int(self.backend.getv('_batch_op'))
+            self.backend.eval('groupscope("::model");')
+        except Exception:
+            raise BatchError(f'Erro no lote: {err}') from err
+        call, (filename, lineno, func) = self.ops[op - 1]
+        raise BatchError(
+            f'Erro no lote na operacao {op} ({call[0]}) chamada em '
+            f'{filename}:{lineno} ({func}): {err}',
+            op, call, (filename, lineno, func)) from err
+
+    def close(self):
+        # ends the batch, also when the script fails: handles of the batch
+        # then talk to the backend instead of queuing into a dead script
+        try:
+            self.flush()
+        finally:
+            self.open = False
+
+    def discard(self):
+        # drops what is queued; objects of the batch then talk to the backend
+        self.script = []
+        self.current = None
+        self.open = False
+
+    def select(self, name):
+        self.record('select', f'select({script_value(name)});', name)
+        self.current = None
+
+    def delete(self):
+        self.record('delete', 'delete;')
+        self.current = None
+
+    def set(self, prop, value):
+        self.record('set', f'set({script_value(prop)}, {script_value(value)});',
+                    prop, value)
+
+    def set_on(self, obj, prop, value):
+        if not self.open:
+            self.backend.select(obj.name)
+            self.backend.set(prop, value)
+            return
+        if self.current is not obj:
+            self.select(obj.name)
+            self.current = obj
+        self.set(prop, value)
+
+    def get_on(self, obj, prop):
+        if self.open:
+            raise RuntimeError(f'{obj.name}: valor indisponivel antes do envio do lote')
+        self.backend.select(obj.name)
+        return self.backend.get(prop)
+
+    def add(self, kind, kwargs):
+        props = dict(kwargs.pop('properties', {}))
+        props.update({key.replace('_', ' '): value for key, value in kwargs.items()})
+        line = f'{kind};' + ''.join(
+            f' set({script_value(prop)}, {script_value(value)});'
+            for prop, value in props.items())
+        self.record(kind, line, props)
+
+        obj = BatchObject(self, props.get('name', DEFAULT_NAMES[kind]))
+        self.current = obj
+        return obj
+
+    def addstructuregroup(self, **kwargs):
+        return self.add('addstructuregroup', kwargs)
+
+    def addmode(self, **kwargs):
+        return self.add('addmode', kwargs)
+
+    def addpower(self, **kwargs):
+        return self.add('addpower', kwargs)
+
+    def addrect(self, **kwargs):
+        return self.add('addrect', kwargs)
+
+    def addfdtd(self, **kwargs):
+        return self.add('addfdtd', kwargs)
+
+    def addprofile(self, **kwargs):
+        return self.add('addprofile', kwargs)
+
+    def addindex(self, **kwargs):
+        return self.add('addindex', kwargs)
+
+    def addmovie(self, **kwargs):
+        return self.add('addmovie', kwargs)
+
+    def adddipole(self, **kwargs):
+        return self.add('adddipole', kwargs)
+
+    def addtime(self, **kwargs):
+        return self.add('addtime', kwargs)
+
+    def eval(self, script):
+        self.record('eval', script, script)
+        self.current = None
+
+    def putv(self, name, value):
+        self.flush()
+        return self.backend.putv(name, value)
+
+    def getv(self, name):
+        self.flush()
+        return self.backend.getv(name)
+
+    def get(self, prop):
+        raise RuntimeError('valor indisponivel antes do envio do lote')
+
+    def importmaterialdb(self, path):
+        self.flush()
+        return self.backend.importmaterialdb(path)
+
+    def save(self, path=None):
+        self.flush()
+        return self.backend.save(path)
+
+    def load(self, path):
+        self.flush()
+        return self.backend.load(path)
+
+    def run(self):
+        self.flush()
+        return self.backend.run()
+
+    def getresult(self, name, result):
+        self.flush()
+        return self.backend.getresult(name, result)
+
+    def materialexists(self, name):
+        self.flush()
+        return self.backend.materialexists(name)
+
+    def switchtolayout(self):
+        self.flush()
+        return self.backend.switchtolayout()
+
+    def deleteall(self):
+        self.flush()
+        return self.backend.deleteall()
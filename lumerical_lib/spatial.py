@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class SpatialIndex(object):
+    # Bucket grid over the records of a hole table (any array with 'x' and
+    # 'y' fields). Records are sorted by bucket, row after row, so the
+    # buckets of one grid row that a box touches are a single slice of
+    # `order`. Query results are indices into the table.
+    def __init__(self, table, cell=None):
+        self.table = table
+        self.x = np.asarray(table['x'], dtype=np.float64)
+        self.y = np.asarray(table['y'], dtype=np.float64)
+
+        if len(table) == 0:
+            self.x0 = self.y0 = 0.0
+            self.cell = cell or 1.0
+            self.nx = self.ny = 0
+            self.order = np.zeros(0, dtype=np.intp)
+            self.starts = np.zeros(1, dtype=np.intp)
+            return
+
+        self.x0 = self.x.min()
+        self.y0 = self.y.min()
+        if cell is None:
+            # about one record per bucket
+            area = (np.ptp(self.x) or 1.0)*(np.ptp(self.y) or 1.0)
+            cell = np.sqrt(area/len(table))
+        self.cell = cell
+
+        ix = ((self.x - self.x0)//cell).astype(np.intp)
+        iy = ((self.y - self.y0)//cell).astype(np.intp)
+        self.nx = ix.max() + 1
+        self.ny = iy.max() + 1
+
+        keys = iy*self.nx + ix
+        self.order = np.argsort(keys, kind='stable')
+        self.starts = np.searchsorted(keys[self.order],
+                                      np.arange(self.nx*self.ny + 1))
+
+    def __len__(self):
+        return len(self.table)
+
+    def query_box(self, xmin, ymin, xmax, ymax):
+        # records with xmin <= x <= xmax and ymin <= y <= ymax
+        ix0 = max(int((xmin - self.x0)//self.cell), 0)
+        ix1 = min(int((xmax - self.x0)//self.cell), self.nx - 1)
+        iy0 = max(int((ymin - self.y0)//self.cell), 0)
+        iy1 = min(int((ymax - self.y0)//self.cell), self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.zeros(0, dtype=np.intp)
+
+        found = np.concatenate([
+            self.order[self.starts[iy*self.nx + ix0]:self.starts[iy*self.nx + ix1 + 1]]
+            for iy in range(iy0, iy1 + 1)])
+        inside = (self.x[found] >= xmin) & (self.x[found] <= xmax) & \
+            (self.y[found] >= ymin) & (self.y[found] <= ymax)
+        return np.sort(found[inside])
+
+    def query_radius(self, x, y, r):
+        # records whose center is at most r from (x, y)
+        found = self.query_box(x - r, y - r, x + r, y + r)
+        near = (self.x[found] - x)**2 + (self.y[found] - y)**2 <= r*r
+        return found[near]
+
+    def pairs(self):
+        # Candidate pairs (i, j), i < j, of records in the same or adjacent
+        # buckets: every pair closer than the bucket size is among them
+        if not len(self.table):
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+        ix = ((self.x - self.x0)//self.cell).astype(np.intp)
+        iy = ((self.y - self.y0)//self.cell).astype(np.intp)
+        first, starts, stops = [], [], []
+        for dy in (-1, 0, 1):
+            row = iy + dy
+            valid = (row >= 0) & (row < self.ny)
+            row = row[valid]
+            start = row*self.nx + np.maximum(ix[valid] - 1, 0)
+            stop = row*self.nx + np.minimum(ix[valid] + 1, self.nx - 1) + 1
+            first.append(np.nonzero(valid)[0])
+            starts.append(self.starts[start])
+            stops.append(self.starts[stop])
+        first = np.concatenate(first)
+        starts = np.concatenate(starts)
+        lengths = np.concatenate(stops) - starts
+
+        # every slice order[start:stop] laid end to end
+        i = np.repeat(first, lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        j = self.order[np.repeat(starts, lengths) + offsets]
+        keep = i < j
+        return i[keep], j[keep]
+
+    def nearest(self, x, y, accept=None):
+        # Index of the closest record to (x, y) among those accepted
+        # (accept(indices) -> bool array, all by default), -1 if there is
+        # none. Only the candidates met by the search are tested. The radius
+        # doubles until a candidate is inside it, a hit within the radius
+        # is the global nearest.
+        span = max(self.nx, self.ny)*self.cell
+        r = self.cell
+        while True:
+            found = self.query_radius(x, y, r)
+            if accept is not None:
+                found = found[accept(found)]
+            if len(found):
+                d = (self.x[found] - x)**2 + (self.y[found] - y)**2
+                return found[np.argmin(d)]
+            if r > 2*span + abs(x - self.x0) + abs(y - self.y0):
+                return -1
+            r *= 2
+
+    def gap(self, x, y):
+        # (bottom, top) of the free vertical span around (x, y): the edges
+        # of the nearest hole below and above it, None where there is none
+        radius = self.table['radius']
+        below = self.nearest(x, y, lambda i: (radius[i] > 0) & (self.y[i] < y))
+        above = self.nearest(x, y, lambda i: (radius[i] > 0) & (self.y[i] > y))
+        bottom = self.y[below] + radius[below] if below >= 0 else None
+        top = self.y[above] - radius[above] if above >= 0 else None
+        return bottom, top
@@ -0,0 +1,147 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from lumerical_lib import crystal as crystal_module
+from lumerical_lib import fdtd as fdtd_module
+from lumerical_lib import pool
+from lumerical_lib import solver
+
+# Parameter sweeps over variants of one crystal. A point is a dict of
+#   a, zspan                          - lattice constant and hole depth
+#   radius_<simbol>                   - radius of a types entry, in units of a
+#   amp, f, offset, pulselength       - arguments of Fdtd.add_sources
+# Each point is built, saved as <name>_<index>.fsp in the work directory
+# and run by a process of the pool. The radii live in the module level types
+# tables, a worker patches them for the length of a point; that is why
+# points run in processes and never in threads.
+
+SOURCE_PARAMS = ('amp', 'f', 'offset', 'pulselength')
+
+# per worker process: one warm session reused by every point it runs
+session_pool = None
+
+
+def grid(**axes):
+    # cartesian product of the axes, as a list of points:
+    # grid(a=[1, 2], f=[3]) -> [{'a': 1, 'f': 3}, {'a': 2, 'f': 3}]
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def set_radii(radii):
+    # radii: {simbol: radius}, -> the previous values
+    previous = {}
+    for simbol, radius in radii.items():
+        previous[simbol] = crystal_module.types[simbol]['radius']
+        for table in (crystal_module.types, fdtd_module.types):
+            table[simbol]['radius'] = radius
+    return previous
+
+
+def start_worker(factory):
+    global session_pool
+    session_pool = pool.SessionPool(1, factory)
+
+
+def build_point(f, name, model, params, path):
+    # builds the variant described by params in the session of f and saves
+    # it to path; the caller patches the radii (set_radii)
+    crystal = crystal_module.Crystal(name, a=params['a'], zspan=params['zspan'],
+                                     model=model)
+    f.add_crystal(crystal, compact=True)
+    f.add_base()
+    f.add_sources(**{key: params[key] for key in SOURCE_PARAMS if key in params})
+    f.add_monitors()
+    f.add_analysis()
+    f.fdtd.save(path)
+
+
+def radii_of(params):
+    return {key[len('radius_'):]: value for key, value in params.items()
+            if key.startswith('radius_')}
+
+
+def read_results(backend, results):
+    return {(monitor, result): backend.getresult(monitor, result)
+            for monitor, result in results}
+
+
+def run_point(index, name, model, base, point, workdir, results):
+    params = dict(base, **point)
+    previous = set_radii(radii_of(params))
+    try:
+        path = os.path.join(workdir, f'{name}_{index}.fsp')
+        with session_pool.session() as f:
+            build_point(f, f'{name}_{index}', model, params, path)
+            f.fdtd.run()
+            output = read_results(f.fdtd, results)
+    finally:
+        set_radii(previous)
+    return index, path, output
+
+
+def axes_of(points):
+    # values taken by each parameter, in order of appearance
+    axes = {}
+    for point in points:
+        for key, value in point.items():
+            axes.setdefault(key, [])
+            if value not in axes[key]:
+                axes[key].append(value)
+    return axes
+
+
+class Dataset(object):
+    # Results of a sweep in the order of its points. results[i] maps
+    # (monitor, result) to the getresult output of point i, errors[i] holds
+    # the error of a point that failed (None otherwise).
+    def __init__(self, points, axes):
+        self.points = points
+        self.axes = axes
+        self.files = [None]*len(points)
+        self.results = [None]*len(points)
+        self.errors = [None]*len(points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def get(self, monitor, result):
+        return [None if output is None else output.get((monitor, result))
+                for output in self.results]
+
+    def select(self, **params):
+        # indices of the points matching every given parameter
+        return [index for index, point in enumerate(self.points)
+                if all(point.get(key) == value for key, value in params.items())]
+
+
+def sweep(crystal, points, results=(('monitor_1', 'T'),), workdir='.',
+          workers=None, licences=None, factory=solver.LumapiBackend):
+    # Runs every point (see grid) on a copy of the crystal in up to
+    # min(workers, licences) processes, by default one per core.
+    # results: (monitor, result) pairs read with getresult after each run.
+    workers = workers or os.cpu_count()
+    if licences is not None:
+        workers = min(workers, licences)
+    workers = max(1, min(workers, len(points)))
+
+    base = {'a': crystal.a, 'zspan': crystal.zspan}
+    os.makedirs(workdir, exist_ok=True)
+    dataset = Dataset(points, axes_of(points))
+    with ProcessPoolExecutor(workers, initializer=start_worker,
+                             initargs=(factory,)) as executor:
+        jobs = {executor.submit(run_point, index, crystal.name, crystal.model,
+                                base, point, workdir, list(results)): index
+                for index, point in enumerate(points)}
+        for job in as_completed(jobs):
+            index = jobs[job]
+            try:
+                __index, path, output = job.result()
+            except Exception as err:
+                dataset.errors[index] = err
+                print(f'[log] Ponto {index} da varredura falhou: {err}')
+                continue
+            dataset.files[index] = path
+            dataset.results[index] = output
+    return dataset
@@ -0,0 +1,174 @@
+import numpy as np
+
+from lumerical_lib.spatial import SpatialIndex
+
+# Geometry checks of a crystal, run before anything is sent to the solver.
+#
+# Conflicts are tuples (kind, (row, col), (row, col) or None):
+#   'overlap' - two circles intersect, a circle cuts into a bend polygon
+#               without being part of it, or two bend polygons intersect
+#   'clip'    - a circle or polygon crosses the edge of the base rectangle
+# Circles with the center inside a bend polygon or on its outline are the
+# holes the bend joins (its ends stop at hole centers), and the companion
+# circle of a bend rounds its own corner, so neither is a conflict with
+# that polygon. Touching shapes are allowed.
+
+# margin of the base rectangle around the lattice, as in Fdtd.add_base
+MARGIN = 0.8E-6
+
+CIRCLE_DTYPE = np.dtype([('x', np.float64), ('y', np.float64),
+                         ('radius', np.float64), ('row', np.intp),
+                         ('col', np.intp), ('bend', np.intp)])
+
+
+def circles(crystal, bends):
+    # lattice circles and bend companions; bend is the index of the bend
+    # owning the companion, -1 for lattice circles
+    table = crystal.hole_table()
+    lattice = table[np.isin(table['code'], crystal.type_codes('circle'))]
+    cells = table[np.isin(table['code'], crystal.type_codes('curve', 'junction'))]
+
+    result = np.empty(len(lattice) + len(bends), dtype=CIRCLE_DTYPE)
+    for field in ('x', 'y', 'radius', 'row', 'col'):
+        result[field][:len(lattice)] = lattice[field]
+    result['bend'][:len(lattice)] = -1
+
+    companions = np.array([bend[3:6] for bend in bends], dtype=np.float64).reshape(-1, 3)
+    result['x'][len(lattice):] = companions[:, 0]
+    result['y'][len(lattice):] = companions[:, 1]
+    result['radius'][len(lattice):] = companions[:, 2]
+    result['row'][len(lattice):] = cells['row']
+    result['col'][len(lattice):] = cells['col']
+    result['bend'][len(lattice):] = np.arange(len(bends))
+    return result
+
+
+def inside_polygon(px, py, vtx):
+    # even-odd rule for every point against one polygon
+    x0, y0 = vtx[:, 0], vtx[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    crosses = (y0[None, :] > py[:, None]) != (y1[None, :] > py[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = x0 + (py[:, None] - y0)*(x1 - x0)/(y1 - y0)
+    return (crosses & (px[:, None] < at)).sum(axis=1) % 2 == 1
+
+
+def edge_distance(px, py, vtx):
+    # distance of every point to the outline of one polygon
+    x0, y0 = vtx[:, 0], vtx[:, 1]
+    dx, dy = np.roll(x0, -1) - x0, np.roll(y0, -1) - y0
+    t = ((px[:, None] - x0)*dx + (py[:, None] - y0)*dy)/(dx*dx + dy*dy)
+    t = np.clip(t, 0, 1)
+    return np.hypot(x0 + t*dx - px[:, None], y0 + t*dy - py[:, None]).min(axis=1)
+
+
+def polygons_overlap(p, q, tol):
+    # True if the areas of two polygons intersect: two edges cross properly
+    # or a vertex of one lies inside the other. Shared vertices and edges
+    # that only touch are not an overlap.
+    p0, p1 = p, np.roll(p, -1, axis=0)
+    q0, q1 = q, np.roll(q, -1, axis=0)
+
+    def side(a0, a1, b):
+        # signed area of (a0, a1, b) for every edge of a against every point b
+        return (a1[:, None, 0] - a0[:, None, 0])*(b[None, :, 1] - a0[:, None, 1]) - \
+            (a1[:, None, 1] - a0[:, None, 1])*(b[None, :, 0] - a0[:, None, 0])
+
+    # sides within eps count as 0, collinear or touching
+    eps = tol*np.ptp(np.concatenate([p, q]), axis=0).max()
+
+    def sign(d):
+        return np.sign(d)*(np.abs(d) > eps)
+
+    s1, s2 = sign(side(q0, q1, p0)).T, sign(side(q0, q1, p1)).T
+    s3, s4 = sign(side(p0, p1, q0)), sign(side(p0, p1, q1))
+    if ((s1*s2 < 0) & (s3*s4 < 0)).any():
+        return True
+
+    for a, b in ((p, q), (q, p)):
+        inside = inside_polygon(a[:, 0], a[:, 1], b) & \
+            (edge_distance(a[:, 0], a[:, 1], b) > tol)
+        if inside.any():
+            return True
+    return False
+
+
+def check(crystal, margin=MARGIN, bounds=None):
+    # bounds: (xmin, ymin, xmax, ymax) of the base rectangle, by default the
+    # lattice of the crystal grown by margin
+    a = crystal.a
+    tol = 1e-6*a
+    h = a*np.sqrt(3)/2
+    if bounds is None:
+        bounds = (-margin, -margin, crystal.x*a + margin, crystal.y*h - h + margin)
+    xmin, ymin, xmax, ymax = bounds
+
+    bends = crystal.bends()
+    holes = circles(crystal, bends)
+    conflicts = []
+
+    def cell(i):
+        return (int(holes['row'][i]), int(holes['col'][i]))
+
+    if len(holes):
+        # circle - circle, bucketed by the widest possible overlap
+        index = SpatialIndex(holes, 2*holes['radius'].max() or a)
+        i, j = index.pairs()
+        d = np.hypot(holes['x'][i] - holes['x'][j], holes['y'][i] - holes['y'][j])
+        hit = d < holes['radius'][i] + holes['radius'][j] - tol
+        for p, q in zip(i[hit].tolist(), j[hit].tolist()):
+            conflicts.append(('overlap', cell(p), cell(q)))
+
+        # circle - base rectangle
+        x, y, r = holes['x'], holes['y'], holes['radius']
+        out = (x - r < xmin - tol) | (x + r > xmax + tol) | \
+            (y - r < ymin - tol) | (y + r > ymax + tol)
+        for p in np.nonzero(out)[0].tolist():
+            conflicts.append(('clip', cell(p), None))
+
+    rmax = holes['radius'].max() if len(holes) else 0
+    for n, (bx, by, vtx, __cx, __cy, __cr, __key) in enumerate(bends):
+        vtx = vtx + (bx, by)
+        where = (int(holes['row'][len(holes) - len(bends) + n]),
+                 int(holes['col'][len(holes) - len(bends) + n]))
+
+        # circle - polygon, only the circles around the polygon's box
+        near = index.query_box(vtx[:, 0].min() - rmax, vtx[:, 1].min() - rmax,
+                               vtx[:, 0].max() + rmax, vtx[:, 1].max() + rmax)
+        near = near[holes['bend'][near] != n]
+        px, py = holes['x'][near], holes['y'][near]
+        d = edge_distance(px, py, vtx)
+        cut = ~inside_polygon(px, py, vtx) & (d > tol) & \
+            (d < holes['radius'][near] - tol)
+        for p in near[cut].tolist():
+            conflicts.append(('overlap', where, cell(p)))
+
+        # polygon - base rectangle
+        if vtx[:, 0].min() < xmin - tol or vtx[:, 0].max() > xmax + tol or \
+                vtx[:, 1].min() < ymin - tol or vtx[:, 1].max() > ymax + tol:
+            conflicts.append(('clip', where, None))
+
+    # polygon - polygon: boxes of the bends bucketed by their centers, a cell
+    # as large as the widest box puts every pair of touching boxes in the
+    # same or adjacent buckets
+    if len(bends):
+        shapes = [vtx + (bx, by) for bx, by, vtx, *__companion in bends]
+        lo = np.array([vtx.min(axis=0) for vtx in shapes])
+        hi = np.array([vtx.max(axis=0) for vtx in shapes])
+        boxes = np.empty(len(bends), dtype=[('x', np.float64), ('y', np.float64)])
+        boxes['x'], boxes['y'] = ((lo + hi)/2).T
+        i, j = SpatialIndex(boxes, (hi - lo).max() or a).pairs()
+        near = (lo[i] < hi[j] - tol).all(axis=1) & (lo[j] < hi[i] - tol).all(axis=1)
+        first = len(holes) - len(bends)
+        for p, q in zip(i[near].tolist(), j[near].tolist()):
+            if polygons_overlap(shapes[p], shapes[q], tol):
+                conflicts.append(('overlap', cell(first + p), cell(first + q)))
+
+    return conflicts
+
+
+def describe(conflict):
+    kind, first, second = conflict
+    if kind == 'clip':
+        return f'Furo em {first} ultrapassa a base'
+    return f'Furos em {first} e {second} se sobrepoem'